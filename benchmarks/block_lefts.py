@@ -0,0 +1,93 @@
+'''
+Benchmark of getBlockLefts and block_left_to_right against the loops they replaced.
+
+The loop versions below are the implementations from before getBlockLefts and
+block_left_to_right were rewritten with np.searchsorted. They walk two pointers over the
+SNPs in Python, so they take O(M) interpreted steps; the searchsorted versions do the
+same work in C, plus a fix-up pass for the few SNPs whose coords[j] - max_dist rounds
+differently from coords[j] - coords[k].
+
+Usage (from the root of the repository):
+
+    python benchmarks/block_lefts.py [n_snp]
+
+With n_snp = 10000000 (the default), a typical run gives
+
+    coords  function             loop      searchsorted
+    bp      getBlockLefts        5.44s     0.444s
+    bp      block_left_to_right  3.31s     0.262s
+    cm      getBlockLefts        4.73s     0.507s
+    cm      block_left_to_right  3.31s     0.226s
+
+and checks that both versions give the same results.
+
+'''
+from __future__ import division
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ldscore.ldscore as ld
+
+
+def getBlockLefts_loop(coords, max_dist):
+    '''getBlockLefts before it used np.searchsorted.'''
+    M = len(coords)
+    j = 0
+    block_left = np.zeros(M)
+    for i in xrange(M):
+        while j < M and abs(coords[j] - coords[i]) > max_dist:
+            j += 1
+
+        block_left[i] = j
+
+    return block_left
+
+
+def block_left_to_right_loop(block_left):
+    '''block_left_to_right before it used np.searchsorted.'''
+    M = len(block_left)
+    j = 0
+    block_right = np.zeros(M)
+    for i in xrange(M):
+        while j < M and block_left[j] <= i:
+            j += 1
+
+        block_right[i] = j
+
+    return block_right
+
+
+def _time(f, *args):
+    t = time.time()
+    x = f(*args)
+    return x, time.time() - t
+
+
+def main(n):
+    np.random.seed(0)
+    # base pair positions with 1 Mb windows, and cM positions (rounded to 4 decimals, so
+    # there are ties and distances exactly equal to max_dist) with 1 cM windows
+    tests = [('bp', np.sort(np.random.randint(0, 250000000, n)), 1000000),
+             ('cm', np.round(np.sort(np.random.rand(n) * 280), 4), 1.0)]
+    print '{:<8}{:<21}{:<10}{}'.format('coords', 'function', 'loop', 'searchsorted')
+    for name, coords, max_dist in tests:
+        ref, t_loop = _time(getBlockLefts_loop, coords, max_dist)
+        block_left, t_new = _time(ld.getBlockLefts, coords, max_dist)
+        if not np.array_equal(ref, block_left):
+            raise ValueError('getBlockLefts does not match the loop version.')
+        print '{:<8}{:<21}{:<10}{}'.format(name, 'getBlockLefts', '{:.3g}s'.format(t_loop),
+                                           '{:.3g}s'.format(t_new))
+
+        ref, t_loop = _time(block_left_to_right_loop, block_left)
+        block_right, t_new = _time(ld.block_left_to_right, block_left)
+        if not np.array_equal(ref, block_right):
+            raise ValueError('block_left_to_right does not match the loop version.')
+        print '{:<8}{:<21}{:<10}{}'.format(name, 'block_left_to_right',
+                                           '{:.3g}s'.format(t_loop), '{:.3g}s'.format(t_new))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    main(n)
@@ -0,0 +1,117 @@
+'''
+Benchmark of LstsqJackknifeFast.block_values against segmented reductions.
+
+block_values computes X^T W X and X^T W Y for each jackknife block with one BLAS call per
+block. The segmented alternatives form the row-wise products x_i * x_j * w (upper triangle
+only) and reduce them over the blocks, either with np.add.reduceat or as differences of
+cumulative sums at the block separators. They have no Python loop over blocks, but they do
+O(n p^2) elementwise work and memory traffic instead of a BLAS syrk/gemm, and have to be
+processed in row chunks to keep the n x p(p+1)/2 products in memory.
+
+Usage (from the root of the repository):
+
+    python benchmarks/block_values.py [n_snp] [n_blocks]
+
+With n_snp = 1000000 and n_blocks = 200, a typical run gives
+
+    p   loop      reduceat  cumsum
+    2   0.00581s  0.0421s   0.0362s
+    20  0.0675s   2.19s     3.15s
+    60  0.461s    11.1s     18.7s
+
+so block_values keeps the loop over blocks.
+
+'''
+from __future__ import division
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ldscore.jackknife as jk
+
+_CHUNK = 2**24  # number of products held in memory at once
+
+
+def _products(x, w, iu, start, stop):
+    '''Row-wise products w * x_i * x_j for the (i, j) in iu, for rows start, ..., stop-1.'''
+    wx = x[start:stop] * w[start:stop]
+    return wx[:, iu[0]] * x[start:stop, iu[1]], wx
+
+
+def _unpack(p, iu, xtx_upper):
+    xtx = np.zeros((xtx_upper.shape[0], p, p))
+    xtx[:, iu[0], iu[1]] = xtx_upper
+    xtx[:, iu[1], iu[0]] = xtx_upper
+    return xtx
+
+
+def block_values_reduceat(x, y, s, w):
+    '''Block values as np.add.reduceat over the block separators.'''
+    n, p = x.shape
+    iu = np.triu_indices(p)
+    n_blocks = len(s) - 1
+    block = np.searchsorted(s, np.arange(n), side='right') - 1
+    xtx = np.zeros((n_blocks, len(iu[0])))
+    xty = np.zeros((n_blocks, p))
+    step = max(1, _CHUNK // len(iu[0]))
+    for start in xrange(0, n, step):
+        stop = min(n, start + step)
+        prod, wx = _products(x, w, iu, start, stop)
+        b = block[start:stop]
+        first = np.r_[0, np.nonzero(np.diff(b))[0] + 1]  # first row of each block in chunk
+        xtx[b[first]] += np.add.reduceat(prod, first, axis=0)
+        xty[b[first]] += np.add.reduceat(wx * y[start:stop], first, axis=0)
+
+    return xty, _unpack(p, iu, xtx)
+
+
+def block_values_cumsum(x, y, s, w):
+    '''Block values as differences of cumulative sums at the block separators.'''
+    n, p = x.shape
+    iu = np.triu_indices(p)
+    s = np.asarray(s)
+    total_xtx = np.zeros(len(iu[0]))
+    total_xty = np.zeros(p)
+    xtx_at_s = np.zeros((len(s), len(iu[0])))  # sums over rows 0, ..., s[k]-1
+    xty_at_s = np.zeros((len(s), p))
+    step = max(1, _CHUNK // len(iu[0]))
+    for start in xrange(0, n, step):
+        stop = min(n, start + step)
+        prod, wx = _products(x, w, iu, start, stop)
+        c_xtx = np.cumsum(prod, axis=0) + total_xtx
+        c_xty = np.cumsum(wx * y[start:stop], axis=0) + total_xty
+        k = np.nonzero((s > start) & (s <= stop))[0]
+        xtx_at_s[k] = c_xtx[s[k] - start - 1]
+        xty_at_s[k] = c_xty[s[k] - start - 1]
+        total_xtx, total_xty = c_xtx[-1], c_xty[-1]
+
+    return np.diff(xty_at_s, axis=0), _unpack(p, iu, np.diff(xtx_at_s, axis=0))
+
+
+def main(n, n_blocks):
+    np.random.seed(0)
+    s = jk.Jackknife.get_separators(n, n_blocks)
+    print '{:<4}{:<10}{:<10}{}'.format('p', 'loop', 'reduceat', 'cumsum')
+    for p in (2, 20, 60):
+        x = np.random.rand(n, p)
+        y = np.random.rand(n, 1)
+        w = np.random.rand(n, 1)
+        times, ref = [], None
+        for f in (jk.LstsqJackknifeFast.block_values, block_values_reduceat,
+                  block_values_cumsum):
+            t = time.time()
+            xty, xtx = f(x, y, s, w)
+            times.append(time.time() - t)
+            if ref is None:
+                ref = (xty, xtx)
+            elif not (np.allclose(xty, ref[0]) and np.allclose(xtx, ref[1])):
+                raise ValueError('{F} does not match block_values.'.format(F=f.__name__))
+
+        print '{:<4}{:<10}{:<10}{}'.format(p, *['{:.3g}s'.format(t) for t in times])
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    main(n, n_blocks)
@@ -15,9 +15,10 @@ import ldscore.sumstats as sumstats
 import ldscore.regressions as reg
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from subprocess import call
 from itertools import product
-import time, sys, traceback, argparse
+import time, sys, traceback, argparse, os, hashlib
 
 
 try:
@@ -41,6 +42,11 @@ pd.set_option('precision', 4)
 pd.set_option('max_colwidth',1000)
 np.set_printoptions(linewidth=1000)
 np.set_printoptions(precision=4)
+# --l2 passes the annot matrix to ldScoreVarBlocks as a CSR matrix if fewer than this
+# fraction of SNPs have a nonzero annotation. The sparse path gathers the annotated columns
+# of every chunk before the GEMMs, which costs about as much as it saves once 30-40% of the
+# SNPs are annotated, so 0.2 leaves a margin.
+SPARSE_ANNOT_FRAC = 0.2
 
 
 def sec_to_str(t):
@@ -116,6 +122,205 @@ def annot_sort_key(s):
 
     return s
 
+
+def _annot_name(fname):
+    '''Strips the directory and the .annot[.gz/.bz2] suffix from an --annot filename.'''
+    name = os.path.basename(fname)
+    for suffix in ['.gz', '.bz2', '.annot']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+
+    return name
+
+
+def _ld_cache_fname(args, array_file, snp_ids, keep_indivs, block_left, chunk_size):
+    '''
+    Returns the name of the --ld-cache file for this run. The key is a checksum of the path,
+    size and modification time of the .bed (or .dos) file (as for the checkpoints of
+    --checkpoint-interval, so the genotypes are not read just to compute the key), the IDs of
+    the SNPs that are kept (after --extract and --maf), the individuals kept by --keep,
+    block_left (which the .bim positions and --ld-wind-* decide), the chunk size actually
+    used (blocks are rounded up to multiples of it, so it decides which pairs of SNPs are in
+    the band) and --precision.
+    '''
+    st = os.stat(array_file)
+    h = hashlib.sha1()
+    h.update(repr((os.path.abspath(array_file), st.st_size, st.st_mtime)))
+    h.update(repr((int(chunk_size), args.precision)))
+    h.update('\n'.join(snp_ids))
+    h.update(np.array(keep_indivs if keep_indivs is not None else [], dtype='int64').tostring())
+    h.update(np.asarray(block_left, dtype='int64').tostring())
+
+    prefix = os.path.splitext(os.path.basename(array_file))[0]
+    name = '{B}.{K}.r2band.npz'.format(B=prefix, K=h.hexdigest()[0:16])
+    return os.path.join(args.ld_cache, name)
+
+
+def _read_ld_cache(fname, m):
+    '''Reads the r^2 band written by _write_ld_cache, or returns None if there is none.'''
+    if not os.path.exists(fname):
+        return None
+
+    x = np.load(fname)
+    if x['shape'][0] != m:
+        raise ValueError('--ld-cache file {F} has the wrong number of SNPs.'.format(F=fname))
+
+    return sparse.csr_matrix((x['data'].astype(np.float32), x['indices'], x['indptr']),
+        shape=tuple(x['shape']))
+
+
+def _write_ld_cache(fname, band):
+    '''Writes the r^2 band as a compressed CSR matrix with float16 entries.'''
+    np.savez_compressed(fname, data=band.data.astype(np.float16),
+        indices=band.indices.astype(np.int32), indptr=band.indptr.astype(np.int64),
+        shape=np.array(band.shape))
+
+
+def _chunk_size(x):
+    '''argparse type for --chunk-size: a positive integer or auto.'''
+    if x == 'auto':
+        return x
+
+    try:
+        x = int(x)
+        if x < 1:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError('--chunk-size must be a positive integer or auto.')
+
+    return x
+
+
+def _tune_chunk_size(args, log, geno_array, block_left):
+    '''Returns --chunk-size, timing a few chunk sizes if it is auto.'''
+    if args.chunk_size != 'auto':
+        return args.chunk_size
+
+    log.log('Timing chunk sizes for LD Score estimation.')
+    chunk_size = geno_array.tuneChunkSize(block_left, precision=args.precision,
+        packed=args.packed)
+    log.log('Using --chunk-size {C}.'.format(C=chunk_size))
+    return chunk_size
+
+
+def _print_ldscore(args, log, out, geno_array, lN, annot_matrix, annot_colnames, scale_suffix):
+    '''
+    Writes the .l2.ldscore.gz, .l2.M and .l2.M_5_50 files with prefix out for the LD Scores
+    lN computed from annot_matrix, and logs summaries.
+
+    '''
+    col_prefix = "L2"; file_suffix = "l2"
+
+    n_annot = lN.shape[1]
+    if n_annot == 1:
+        ldscore_colnames = [col_prefix+scale_suffix]
+    else:
+        ldscore_colnames =  [y+col_prefix+scale_suffix for y in annot_colnames]
+
+    # print .ldscore. Output columns: CHR, BP, RS, [LD Scores]
+    out_fname = out + '.' + file_suffix + '.ldscore'
+    new_colnames = geno_array.colnames + ldscore_colnames
+    df = pd.DataFrame.from_records(np.c_[geno_array.df, lN])
+    df.columns = new_colnames
+    if args.print_snps:
+        if args.print_snps.endswith('gz'):
+            print_snps = pd.read_csv(args.print_snps, header=None, compression='gzip')
+        elif args.print_snps.endswith('bz2'):
+            print_snps = pd.read_csv(args.print_snps, header=None, compression='bz2')
+        else:
+            print_snps = pd.read_csv(args.print_snps, header=None)
+        if len(print_snps.columns) > 1:
+            raise ValueError('--print-snps must refer to a file with a one column of SNP IDs.')
+        log.log('Reading list of {N} SNPs for which to print LD Scores from {F}'.format(\
+                        F=args.print_snps, N=len(print_snps)))
+
+        print_snps.columns=['SNP']
+        df = df.ix[df.SNP.isin(print_snps.SNP),:]
+        if len(df) == 0:
+            raise ValueError('After merging with --print-snps, no SNPs remain.')
+        else:
+            msg = 'After merging with --print-snps, LD Scores for {N} SNPs will be printed.'
+            log.log(msg.format(N=len(df)))
+
+    if annot_matrix is not None:
+        M = np.atleast_1d(np.squeeze(np.asarray(np.sum(annot_matrix, axis=0))))
+        ii = geno_array.maf > 0.05
+        M_5_50 = np.atleast_1d(np.squeeze(np.asarray(np.sum(annot_matrix[ii,:], axis=0))))
+    else:
+        M = [geno_array.m]
+        M_5_50 = [np.sum(geno_array.maf > 0.05)]
+
+    if args.binary_ldscore:
+        l2_suffix = '.bin'
+        log.log("Writing LD Scores for {N} SNPs to {f}.bin".format(f=out_fname, N=len(df)))
+        ps.write_ldscore_bin(out_fname + l2_suffix, df.drop(['CM','MAF'], axis=1), M, M_5_50)
+    else:
+        l2_suffix = '.gz'
+        log.log("Writing LD Scores for {N} SNPs to {f}.gz".format(f=out_fname, N=len(df)))
+        df.drop(['CM','MAF'], axis=1).to_csv(out_fname, sep="\t", header=True, index=False,
+            float_format='%.3f')
+        call(['gzip', '-f', out_fname])
+
+    # print .M
+    fout_M = open(out + '.'+ file_suffix +'.M','wb')
+    print >>fout_M, '\t'.join(map(str,M))
+    fout_M.close()
+
+    # print .M_5_50
+    fout_M_5_50 = open(out + '.'+ file_suffix +'.M_5_50','wb')
+    print >>fout_M_5_50, '\t'.join(map(str,M_5_50))
+    fout_M_5_50.close()
+
+    # print annot matrix
+    if (args.cts_bin is not None) and not args.no_print_annot:
+        out_fname_annot = out + '.annot'
+        new_colnames = geno_array.colnames + ldscore_colnames
+        annot_df = pd.DataFrame(np.c_[geno_array.df, annot_matrix])
+        annot_df.columns = new_colnames
+        del annot_df['MAF']
+        log.log("Writing annot matrix produced by --cts-bin to {F}".format(F=out_fname+'.gz'))
+        annot_df.to_csv(out_fname_annot, sep="\t", header=True, index=False)
+        call(['gzip', '-f', out_fname_annot])
+
+    # print LD Score summary
+    pd.set_option('display.max_rows', 200)
+    log.log('\nSummary of LD Scores in {F}'.format(F=out_fname+l2_suffix))
+    t = df.ix[:,4:].describe()
+    log.log( t.ix[1:,:] )
+
+    np.seterr(divide='ignore', invalid='ignore')  # print NaN instead of weird errors
+    # print correlation matrix including all LD Scores and sample MAF
+    log.log('')
+    log.log('MAF/LD Score Correlation Matrix')
+    log.log( df.ix[:,4:].corr() )
+
+    # print condition number
+    if n_annot > 1: # condition number of a column vector w/ nonzero var is trivially one
+        log.log('\nLD Score Matrix Condition Number')
+        cond_num = np.linalg.cond(df.ix[:,5:])
+        log.log( reg.remove_brackets(str(np.matrix(cond_num))) )
+        if cond_num > 10000:
+            log.log('WARNING: ill-conditioned LD Score Matrix!')
+
+    # summarize annot matrix if there is one
+    if annot_matrix is not None:
+        # covariance matrix
+        x = pd.DataFrame(annot_matrix, columns=annot_colnames)
+        log.log('\nAnnotation Correlation Matrix')
+        log.log( x.corr() )
+
+        # column sums
+        log.log('\nAnnotation Matrix Column Sums')
+        log.log(_remove_dtype(x.sum(axis=0)))
+
+        # row sums
+        log.log('\nSummary of Annotation Matrix Row Sums')
+        row_sums = x.sum(axis=1).describe()
+        log.log(_remove_dtype(row_sums))
+
+    np.seterr(divide='raise', invalid='raise')
+
+
 def ldscore(args, log):
     '''
     Wrapper function for estimating l1, l1^2, l2 and l4 (+ optionally standard errors) from
@@ -130,35 +335,61 @@ def ldscore(args, log):
         snp_file, snp_obj = args.bfile+'.bim', ps.PlinkBIMFile
         ind_file, ind_obj = args.bfile+'.fam', ps.PlinkFAMFile
         array_file, array_obj = args.bfile+'.bed', ld.PlinkBEDFile
+        if args.memmap:
+            array_obj = ld.PlinkBEDFileMemmap
+    elif args.dosage:
+        snp_file, snp_obj = args.dosage+'.bim', ps.PlinkBIMFile
+        ind_file, ind_obj = args.dosage+'.fam', ps.PlinkFAMFile
+        array_file, array_obj = args.dosage+'.dos', ld.DosageFile
 
     # read bim/snp
     array_snps = snp_obj(snp_file)
     m = len(array_snps.IDList)
     log.log('Read list of {m} SNPs from {f}'.format(m=m, f=snp_file))
+    annot_sets = None  # (output prefix, annot columns) for each --annot file
     if args.annot is not None:  # read --annot
-        try:
-            if args.thin_annot: # annot file has only annotations
-                annot = ps.ThinAnnotFile(args.annot)
-                n_annot, ma = len(annot.df.columns), len(annot.df)
-                log.log("Read {A} annotations for {M} SNPs from {f}".format(f=args.annot,
-                    A=n_annot, M=ma))
-                annot_matrix = annot.df.values
-                annot_colnames = annot.df.columns
-                keep_snps = None
+        annot_fnames = sumstats._splitp(args.annot)
+        annot_names = [_annot_name(annot_fname) for annot_fname in annot_fnames]
+        if len(annot_fnames) > 1 and len(set(annot_names)) < len(annot_names):
+            raise ValueError('The --annot files must have distinct names (after removing the '
+                'directory and .annot suffix), since the name of each file is used in the '
+                'names of its output files.')
+        annot_matrices, annot_colnames, annot_sets = [], [], []
+        for annot_fname, annot_name in zip(annot_fnames, annot_names):
+            try:
+                if args.thin_annot: # annot file has only annotations
+                    annot = ps.ThinAnnotFile(annot_fname)
+                    n_annot, ma = len(annot.df.columns), len(annot.df)
+                    log.log("Read {A} annotations for {M} SNPs from {f}".format(f=annot_fname,
+                        A=n_annot, M=ma))
+                    annot_matrices.append(annot.df.values)
+                    colnames = list(annot.df.columns)
+                else:
+                    annot = ps.AnnotFile(annot_fname)
+                    n_annot, ma = len(annot.df.columns) - 4, len(annot.df)
+                    log.log("Read {A} annotations for {M} SNPs from {f}".format(f=annot_fname,
+                        A=n_annot, M=ma))
+                    annot_matrices.append(np.array(annot.df.iloc[:,4:]))
+                    colnames = list(annot.df.columns[4:])
+                    if np.any(annot.df.SNP.values != array_snps.df.SNP.values):
+                        raise ValueError('The .annot file must contain the same SNPs in the same'+\
+                            ' order as the .bim file.')
+            except Exception:
+                log.log('Error parsing .annot file')
+                raise
+
+            if len(annot_fnames) > 1:
+                out = args.out + '.' + annot_name
             else:
-                annot = ps.AnnotFile(args.annot)
-                n_annot, ma = len(annot.df.columns) - 4, len(annot.df)
-                log.log("Read {A} annotations for {M} SNPs from {f}".format(f=args.annot,
-                    A=n_annot, M=ma))
-                annot_matrix = np.array(annot.df.iloc[:,4:])
-                annot_colnames = annot.df.columns[4:]
-                keep_snps = None
-                if np.any(annot.df.SNP.values != array_snps.df.SNP.values):
-                    raise ValueError('The .annot file must contain the same SNPs in the same'+\
-                        ' order as the .bim file.')
-        except Exception:
-            log.log('Error parsing .annot file')
-            raise
+                out = args.out
+            i = len(annot_colnames)
+            annot_sets.append((out, slice(i, i + len(colnames))))
+            annot_colnames += colnames
+
+        # one genotype pass for all --annot files
+        annot_matrix = np.hstack(annot_matrices)
+        n_annot = len(annot_colnames)
+        keep_snps = None
 
     elif args.extract is not None:  # --extract
         keep_snps = __filter__(args.extract, 'SNPs', 'include', array_snps)
@@ -313,110 +544,58 @@ def ldscore(args, log):
             annot_matrix = pq
 
     log.log("Estimating LD Score.")
-    lN = geno_array.ldScoreVarBlocks(block_left, args.chunk_size, annot=annot_matrix)
-    col_prefix = "L2"; file_suffix = "l2"
+    if args.threads > 1:
+        log.log('Splitting the SNPs into {T} segments.'.format(T=args.threads))
+    annot_arg = annot_matrix
+    if annot_matrix is not None and args.ld_cache is None and not args.no_sparse_annot:
+        frac_annot = np.mean(np.any(annot_matrix != 0, axis=1))
+        if frac_annot < SPARSE_ANNOT_FRAC:
+            msg = '{P:.1%} of SNPs have a nonzero annotation. Using a sparse annot matrix.'
+            log.log(msg.format(P=frac_annot))
+            annot_arg = sparse.csr_matrix(annot_matrix)
+
+    if args.packed:
+        log.log('Computing correlations from packed genotypes.')
+    elif args.precision != 'float64':
+        log.log('Computing correlations in {P} precision.'.format(P=args.precision))
+    checkpoint = None
+    if args.ld_cache is not None:
+        chunk_size = _tune_chunk_size(args, log, geno_array, block_left)
+        snp_ids = np.array(array_snps.df['SNP'])[geno_array.kept_snps]
+        cache_fname = _ld_cache_fname(args, array_file, snp_ids, keep_indivs, block_left,
+            chunk_size)
+        band = _read_ld_cache(cache_fname, geno_array.m)
+        if band is not None:
+            log.log('Reading r^2 band from {F}'.format(F=cache_fname))
+            lN = ld.band_cor_sum(band, annot_matrix)
+        else:  # the LD Scores of this run are computed from the unrounded correlations
+            lN, band = geno_array.ldScoreBand(block_left, chunk_size, annot=annot_matrix,
+                threads=args.threads, precision=args.precision, packed=args.packed)
+            log.log('Writing r^2 band to {F}'.format(F=cache_fname))
+            _write_ld_cache(cache_fname, band)
+            del band
 
-    if n_annot == 1:
-        ldscore_colnames = [col_prefix+scale_suffix]
     else:
-        ldscore_colnames =  [y+col_prefix+scale_suffix for y in annot_colnames]
-
-    # print .ldscore. Output columns: CHR, BP, RS, [LD Scores]
-    out_fname = args.out + '.' + file_suffix + '.ldscore'
-    new_colnames = geno_array.colnames + ldscore_colnames
-    df = pd.DataFrame.from_records(np.c_[geno_array.df, lN])
-    df.columns = new_colnames
-    if args.print_snps:
-        if args.print_snps.endswith('gz'):
-            print_snps = pd.read_csv(args.print_snps, header=None, compression='gzip')
-        elif args.print_snps.endswith('bz2'):
-            print_snps = pd.read_csv(args.print_snps, header=None, compression='bz2')
-        else:
-            print_snps = pd.read_csv(args.print_snps, header=None)
-        if len(print_snps.columns) > 1:
-            raise ValueError('--print-snps must refer to a file with a one column of SNP IDs.')
-        log.log('Reading list of {N} SNPs for which to print LD Scores from {F}'.format(\
-                        F=args.print_snps, N=len(print_snps)))
-
-        print_snps.columns=['SNP']
-        df = df.ix[df.SNP.isin(print_snps.SNP),:]
-        if len(df) == 0:
-            raise ValueError('After merging with --print-snps, no SNPs remain.')
-        else:
-            msg = 'After merging with --print-snps, LD Scores for {N} SNPs will be printed.'
-            log.log(msg.format(N=len(df)))
-
-    l2_suffix = '.gz'
-    log.log("Writing LD Scores for {N} SNPs to {f}.gz".format(f=out_fname, N=len(df)))
-    df.drop(['CM','MAF'], axis=1).to_csv(out_fname, sep="\t", header=True, index=False,
-        float_format='%.3f')
-    call(['gzip', '-f', out_fname])
-    if annot_matrix is not None:
-        M = np.atleast_1d(np.squeeze(np.asarray(np.sum(annot_matrix, axis=0))))
-        ii = geno_array.maf > 0.05
-        M_5_50 = np.atleast_1d(np.squeeze(np.asarray(np.sum(annot_matrix[ii,:], axis=0))))
-    else:
-        M = [geno_array.m]
-        M_5_50 = [np.sum(geno_array.maf > 0.05)]
-
-    # print .M
-    fout_M = open(args.out + '.'+ file_suffix +'.M','wb')
-    print >>fout_M, '\t'.join(map(str,M))
-    fout_M.close()
-
-    # print .M_5_50
-    fout_M_5_50 = open(args.out + '.'+ file_suffix +'.M_5_50','wb')
-    print >>fout_M_5_50, '\t'.join(map(str,M_5_50))
-    fout_M_5_50.close()
-
-    # print annot matrix
-    if (args.cts_bin is not None) and not args.no_print_annot:
-        out_fname_annot = args.out + '.annot'
-        new_colnames = geno_array.colnames + ldscore_colnames
-        annot_df = pd.DataFrame(np.c_[geno_array.df, annot_matrix])
-        annot_df.columns = new_colnames
-        del annot_df['MAF']
-        log.log("Writing annot matrix produced by --cts-bin to {F}".format(F=out_fname+'.gz'))
-        annot_df.to_csv(out_fname_annot, sep="\t", header=True, index=False)
-        call(['gzip', '-f', out_fname_annot])
-
-    # print LD Score summary
-    pd.set_option('display.max_rows', 200)
-    log.log('\nSummary of LD Scores in {F}'.format(F=out_fname+l2_suffix))
-    t = df.ix[:,4:].describe()
-    log.log( t.ix[1:,:] )
-
-    np.seterr(divide='ignore', invalid='ignore')  # print NaN instead of weird errors
-    # print correlation matrix including all LD Scores and sample MAF
-    log.log('')
-    log.log('MAF/LD Score Correlation Matrix')
-    log.log( df.ix[:,4:].corr() )
-
-    # print condition number
-    if n_annot > 1: # condition number of a column vector w/ nonzero var is trivially one
-        log.log('\nLD Score Matrix Condition Number')
-        cond_num = np.linalg.cond(df.ix[:,5:])
-        log.log( reg.remove_brackets(str(np.matrix(cond_num))) )
-        if cond_num > 10000:
-            log.log('WARNING: ill-conditioned LD Score Matrix!')
-
-    # summarize annot matrix if there is one
-    if annot_matrix is not None:
-        # covariance matrix
-        x = pd.DataFrame(annot_matrix, columns=annot_colnames)
-        log.log('\nAnnotation Correlation Matrix')
-        log.log( x.corr() )
-
-        # column sums
-        log.log('\nAnnotation Matrix Column Sums')
-        log.log(_remove_dtype(x.sum(axis=0)))
-
-        # row sums
-        log.log('\nSummary of Annotation Matrix Row Sums')
-        row_sums = x.sum(axis=1).describe()
-        log.log(_remove_dtype(row_sums))
+        chunk_size = _tune_chunk_size(args, log, geno_array, block_left)
+        if args.checkpoint_interval is not None:
+            checkpoint = (args.out + '.l2.ckpt.npz', args.checkpoint_interval)
+            if args.resume and os.path.exists(checkpoint[0]):
+                log.log('Resuming from checkpoint {F}'.format(F=checkpoint[0]))
+            else:
+                log.log('Writing checkpoints to {F}'.format(F=checkpoint[0]))
+        lN = geno_array.ldScoreVarBlocks(block_left, chunk_size, annot=annot_arg,
+            threads=args.threads, precision=args.precision, packed=args.packed,
+            checkpoint=checkpoint, resume=args.resume)
+    if annot_sets is None:
+        _print_ldscore(args, log, args.out, geno_array, lN, annot_matrix, annot_colnames,
+            scale_suffix)
+    else:  # one set of output files per --annot file
+        for out, ii in annot_sets:
+            _print_ldscore(args, log, out, geno_array, lN[:, ii], annot_matrix[:, ii],
+                annot_colnames[ii], scale_suffix)
+    if checkpoint is not None and os.path.exists(checkpoint[0]):
+        os.remove(checkpoint[0])
 
-    np.seterr(divide='raise', invalid='raise')
 
 
 parser = argparse.ArgumentParser()
@@ -426,6 +605,9 @@ parser.add_argument('--out', default='ldsc', type=str,
 # Basic LD Score Estimation Flags'
 parser.add_argument('--bfile', default=None, type=str,
     help='Prefix for Plink .bed/.bim/.fam file')
+parser.add_argument('--dosage', default=None, type=str,
+    help='Prefix for allele dosages in .dos format (see ldscore.ldscore.write_dosage) with '
+    'Plink .bim/.fam files. Use instead of --bfile for imputed reference panels.')
 parser.add_argument('--l2', default=False, action='store_true',
     help='Estimate l2. Compatible with both jackknife and non-jackknife.')
 # Filtering / Data Management for LD Score
@@ -453,7 +635,10 @@ parser.add_argument('--print-snps', default=None, type=str,
 parser.add_argument('--annot', default=None, type=str,
     help='Filename prefix for annotation file for partitioned LD Score estimation. '
     'LDSC will automatically append .annot or .annot.gz to the filename prefix. '
-    'See docs/file_formats_ld for a definition of the .annot format.')
+    'See docs/file_formats_ld for a definition of the .annot format. '
+    'If this is a comma-separated list of files, the LD Scores for all of them are '
+    'computed in a single pass over the genotypes, and the output for each file is '
+    'written with prefix OUT.<file name without .annot[.gz]>.')
 parser.add_argument('--thin-annot', action='store_true', default=False,
     help='This flag says your annot files have only annotations, with no SNP, CM, CHR, BP columns.')
 parser.add_argument('--cts-bin', default=None, type=str,
@@ -485,12 +670,65 @@ parser.add_argument('--no-print-annot', default=False, action='store_true',
     help='By defualt, seting --cts-bin or --cts-bin-add causes LDSC to print '
     'the resulting annot matrix. Setting --no-print-annot tells LDSC not '
     'to print the annot matrix. ')
+parser.add_argument('--no-sparse-annot', default=False, action='store_true',
+    help='By default, if fewer than {P:g}%% of SNPs have a nonzero annotation, --l2 stores '
+    'the annot matrix as a sparse matrix and only multiplies the genotypes of annotated SNPs. '
+    'Setting --no-sparse-annot always uses the dense annot matrix. The LD Scores are the '
+    'same either way.'.format(P=100*SPARSE_ANNOT_FRAC))
 parser.add_argument('--maf', default=None, type=float,
     help='Minor allele frequency lower bound. Default is MAF > 0.')
+parser.add_argument('--threads', default=1, type=int,
+    help='Number of processes to use for LD Score estimation. The SNPs are split into '
+    'this many contiguous segments, and the LD Scores for each segment are computed in a '
+    'separate process. The results are identical to --threads 1. With --h2, --h2-cts and '
+    '--rg, the per-chromosome files of --ref-ld-chr, --w-ld-chr and the .annot files of '
+    '--overlap-annot are read by this many processes. With --h2-batch, this many traits are '
+    'analyzed in parallel.')
+parser.add_argument('--precision', default='float64', type=str,
+    choices=['float64', 'float32'],
+    help='Floating point precision of the genotype window and correlation matrices used '
+    'for LD Score estimation. float32 halves the memory used by the LD window and is '
+    'faster, at the cost of LD Scores that differ from float64 in about the sixth '
+    'significant digit. Sums of r^2 are always accumulated in float64.')
+parser.add_argument('--memmap', default=False, action='store_true',
+    help='Memory-map the .bed file instead of reading it into memory. Only the genotypes '
+    'of the SNPs in the current LD window are read from disk, which greatly reduces memory '
+    'usage for reference panels with many individuals.')
+parser.add_argument('--ld-cache', default=None, type=str,
+    help='Directory for caching the band of r^2 within the LD windows. The first run with '
+    'a given .bed file (identified by its path, size and modification time), .bim '
+    'positions, --ld-wind-*, --maf, --extract, --keep, --chunk-size and --precision '
+    'writes the band to this directory; later runs (e.g., with different '
+    '--annot files) reuse it instead of computing correlations. The first run computes its '
+    'LD Scores from the exact correlations, but the cached r^2 are stored with float16 '
+    'precision, so LD Scores read from the cache differ from LD Scores computed without '
+    'it in about the fourth significant digit.')
+parser.add_argument('--packed', default=False, action='store_true',
+    help='Keep the genotypes in the LD window as bit planes of the packed .bed genotypes '
+    '(4 bits per individual) and compute correlations from popcounts, instead of decoding '
+    'them to floats. The LD window takes 16 times less memory than with --precision float64 '
+    '(8 times less than with float32), but the LD Scores take about 2-3 times longer to '
+    'compute without missing genotypes and about 6 times longer with them. --precision is '
+    'ignored.')
+parser.add_argument('--checkpoint-interval', default=None, type=float,
+    help='Write the state of the LD Score computation to OUT.l2.ckpt.npz every this many '
+    'seconds, so that an interrupted run can be continued with --resume. The checkpoint '
+    'is deleted once the LD Scores have been written. Requires --threads 1.')
+parser.add_argument('--resume', default=False, action='store_true',
+    help='Continue an interrupted run from OUT.l2.ckpt.npz instead of starting over. The '
+    'other flags must be the same as in the interrupted run (use a fixed --chunk-size '
+    'rather than --chunk-size auto). The LD Scores are identical to an uninterrupted run.')
 # Basic Flags for Working with Variance Components
 parser.add_argument('--h2', default=None, type=str,
     help='Filename for a .sumstats[.gz] file for one-phenotype LD Score regression. '
     '--h2 requires at minimum also setting the --ref-ld and --w-ld flags.')
+parser.add_argument('--h2-batch', default=None, type=str,
+    help='Filename for a manifest of .sumstats[.gz] files for one-phenotype LD Score '
+    'regression on many traits. Each line has the path to a .sumstats file and optionally a '
+    'trait name (default: the file name without the .sumstats[.gz] suffix). The LD Scores '
+    'are read once and shared by all traits. Each trait is logged to <out>.<trait>.log, and '
+    'the estimates for all traits are written to <out>.h2.results. Use --threads to analyze '
+    'several traits in parallel.')
 parser.add_argument('--h2-cts', default=None, type=str,
     help='Filename for a .sumstats[.gz] file for cell-type-specific analysis. '
     '--h2-cts requires the --ref-ld-chr, --w-ld, and --ref-ld-chr-cts flags.')
@@ -540,6 +778,11 @@ parser.add_argument('--two-step', default=None, type=float,
     help='Test statistic bound for use with the two-step estimator. Not compatible with --no-intercept and --constrain-intercept.')
 parser.add_argument('--chisq-max', default=None, type=float,
     help='Max chi^2.')
+parser.add_argument('--irwls-max-iter', default=2, type=int,
+    help='Maximum number of IRWLS re-weighting steps for --h2 and --rg (default 2).')
+parser.add_argument('--irwls-tol', default=None, type=float,
+    help='Stop IRWLS re-weighting once the largest relative change in the regression weights '
+    'is below this value. By default exactly --irwls-max-iter steps are run.')
 parser.add_argument('--ref-ld-chr-cts', default=None, type=str,
     help='Name of a file that has a list of file name prefixes for cell-type-specific analysis.')
 parser.add_argument('--print-all-cts', action='store_true', default=False)
@@ -554,10 +797,19 @@ parser.add_argument('--print-delete-vals', default=False, action='store_true',
     'The delete-values are formatted as a matrix with (# of jackknife blocks) rows and '
     '(# of LD Scores) columns.')
 # Flags you should almost never use
-parser.add_argument('--chunk-size', default=50, type=int,
-    help='Chunk size for LD Score calculation. Use the default.')
-parser.add_argument('--pickle', default=False, action='store_true',
-    help='Store .l2.ldscore files as pickles instead of gzipped tab-delimited text.')
+parser.add_argument('--chunk-size', default=50, type=_chunk_size,
+    help='Chunk size for LD Score calculation. Use the default. With --chunk-size auto, '
+    'LDSC times a few chunk sizes on a segment of the chromosome and uses the fastest; '
+    'the chosen chunk size is logged. LD Scores depend slightly on the chunk size, since '
+    'the LD windows are rounded to multiples of it.')
+parser.add_argument('--binary-ldscore', '--pickle', default=False, action='store_true',
+    dest='binary_ldscore',
+    help='Write LD Scores to a binary columnar .l2.ldscore.bin file instead of gzipped '
+    'tab-delimited text. The LD Scores are stored as float32 and M / M_5_50 are embedded '
+    'in the file (the .M / .M_5_50 files are still written). --ref-ld and --w-ld read '
+    '.l2.ldscore.bin files in place of text files with the same prefix, through memory '
+    'mapping (the LD Scores are converted to float64 in memory for the regression). --pickle '
+    'is an older name for this flag.')
 parser.add_argument('--yes-really', default=False, action='store_true',
     help='Yes, I really want to compute whole-chromosome LD Score.')
 parser.add_argument('--invert-anyway', default=False, action='store_true',
@@ -600,9 +852,13 @@ if __name__ == '__main__':
         start_time = time.time()
         if args.n_blocks <= 1:
             raise ValueError('--n-blocks must be an integer > 1.')
-        if args.bfile is not None:
+        if args.bfile is not None or args.dosage is not None:
             if args.l2 is None:
-                raise ValueError('Must specify --l2 with --bfile.')
+                raise ValueError('Must specify --l2 with --bfile or --dosage.')
+            if args.bfile is not None and args.dosage is not None:
+                raise ValueError('Cannot set both --bfile and --dosage.')
+            if args.dosage is not None and (args.packed or args.memmap):
+                raise ValueError('--packed and --memmap require --bfile.')
             if args.annot is not None and args.extract is not None:
                 raise ValueError('--annot and --extract are currently incompatible.')
             if args.cts_bin is not None and args.extract is not None:
@@ -615,19 +871,34 @@ if __name__ == '__main__':
                 raise ValueError('Cannot set both --per-allele and --pq-exp (--per-allele is equivalent to --pq-exp 1).')
             if args.per_allele:
                 args.pq_exp = 1
+            if args.threads < 1:
+                raise ValueError('--threads must be an integer >= 1.')
+            if args.resume and args.checkpoint_interval is None:
+                raise ValueError('--resume requires --checkpoint-interval.')
+            if args.checkpoint_interval is not None and (args.threads > 1 or args.ld_cache):
+                raise ValueError('--checkpoint-interval cannot be combined with --threads > 1 '
+                    'or --ld-cache.')
 
 
             ldscore(args, log)
         # summary statistics
-        elif (args.h2 or args.rg or args.h2_cts) and (args.ref_ld or args.ref_ld_chr) and (args.w_ld or args.w_ld_chr):
+        elif (args.h2 or args.rg or args.h2_cts or args.h2_batch) and (args.ref_ld or args.ref_ld_chr) and (args.w_ld or args.w_ld_chr):
             if args.h2 is not None and args.rg is not None:
                 raise ValueError('Cannot set both --h2 and --rg.')
+            if args.h2_batch is not None and (args.h2 is not None or args.rg is not None):
+                raise ValueError('Cannot set --h2-batch with --h2 or --rg.')
+            if args.threads < 1:
+                raise ValueError('--threads must be an integer >= 1.')
             if args.ref_ld and args.ref_ld_chr:
                 raise ValueError('Cannot set both --ref-ld and --ref-ld-chr.')
             if args.w_ld and args.w_ld_chr:
                 raise ValueError('Cannot set both --w-ld and --w-ld-chr.')
             if (args.samp_prev is not None) != (args.pop_prev is not None):
                 raise ValueError('Must set both or neither of --samp-prev and --pop-prev.')
+            if args.irwls_max_iter < 1:
+                raise ValueError('--irwls-max-iter must be an integer >= 1.')
+            if args.irwls_tol is not None and args.irwls_tol <= 0:
+                raise ValueError('--irwls-tol must be > 0.')
 
             if not args.overlap_annot or args.not_M_5_50:
                 if args.frqfile is not None or args.frqfile_chr is not None:
@@ -642,6 +913,8 @@ if __name__ == '__main__':
                 sumstats.estimate_rg(args, log)
             elif args.h2:
                 sumstats.estimate_h2(args, log)
+            elif args.h2_batch:
+                sumstats.estimate_h2_batch(args, log)
             elif args.h2_cts:
                 sumstats.cell_type_specific(args, log)
 
@@ -29,6 +29,17 @@ class IRWLS(object):
         inverse CVF scale.
     slow : bool
         Use slow block jackknife? (Mostly for testing)
+    separators : list or None
+        Block jackknife block boundaries (optional).
+    gram : bool
+        Solve each WLS step from the weighted Gram matrices X^T W X and X^T W Y, accumulated
+        per jackknife block, instead of calling np.linalg.lstsq on weighted copies of x and y.
+        Ignored if slow is True.
+    max_iter : int
+        Maximum number of re-weighting steps (default 2).
+    tol : float or None
+        Stop re-weighting once the largest relative change in the weights is below tol. If
+        None (default), exactly max_iter steps are run.
 
     Attributes
     ----------
@@ -44,17 +55,24 @@ class IRWLS(object):
         Covariance matrix of jackknifed estimate.
     delete_values : np.matrix with shape (n_blocks, p)
         Jackknife delete values.
+    n_iter : int
+        Number of re-weighting steps run.
+    w_deltas : list of floats
+        Largest relative change in the weights at each re-weighting step.
 
     Methods
     -------
     wls(x, y, w) :
         Weighted Least Squares.
+    wls_gram(x, y, w, s) :
+        Weighted Least Squares from block Gram matrices.
     _weight(x, w) :
         Weight x by w.
 
     '''
 
-    def __init__(self, x, y, update_func, n_blocks, w=None, slow=False, separators=None):
+    def __init__(self, x, y, update_func, n_blocks, w=None, slow=False, separators=None,
+                 gram=True, max_iter=2, tol=None):
         n, p = jk._check_shape(x, y)
         if w is None:
             w = np.ones_like(y)
@@ -62,8 +80,10 @@ class IRWLS(object):
             raise ValueError(
                 'w has shape {S}. w must have shape ({N}, 1).'.format(S=w.shape, N=n))
 
-        jknife = self.irwls(
-            x, y, update_func, n_blocks, w, slow=slow, separators=separators)
+        jknife, self.w_deltas = self._irwls(
+            x, y, update_func, n_blocks, w, slow=slow, separators=separators, gram=gram,
+            max_iter=max_iter, tol=tol)
+        self.n_iter = len(self.w_deltas)
         self.est = jknife.est
         self.jknife_se = jknife.jknife_se
         self.jknife_est = jknife.jknife_est
@@ -73,7 +93,8 @@ class IRWLS(object):
         self.separators = jknife.separators
 
     @classmethod
-    def irwls(cls, x, y, update_func, n_blocks, w, slow=False, separators=None):
+    def irwls(cls, x, y, update_func, n_blocks, w, slow=False, separators=None, gram=True,
+              max_iter=2, tol=None):
         '''
         Iteratively re-weighted least squares (IRWLS).
 
@@ -93,6 +114,13 @@ class IRWLS(object):
             Use slow block jackknife? (Mostly for testing)
         separators : list or None
             Block jackknife block boundaries (optional).
+        gram : bool
+            Solve from per-block weighted Gram matrices (ignored if slow is True).
+        max_iter : int
+            Maximum number of re-weighting steps.
+        tol : float or None
+            Stop re-weighting once the largest relative change in the weights is below tol. If
+            None, exactly max_iter steps are run.
 
         Returns
         -------
@@ -100,6 +128,13 @@ class IRWLS(object):
             Block jackknife regression with the final IRWLS weights.
 
         '''
+        return cls._irwls(x, y, update_func, n_blocks, w, slow=slow, separators=separators,
+                          gram=gram, max_iter=max_iter, tol=tol)[0]
+
+    @classmethod
+    def _irwls(cls, x, y, update_func, n_blocks, w, slow=False, separators=None, gram=True,
+               max_iter=2, tol=None):
+        '''IRWLS. Returns the jackknife and the weight change at each step.'''
         (n, p) = x.shape
         if y.shape != (n, 1):
             raise ValueError(
@@ -107,16 +142,21 @@ class IRWLS(object):
         if w.shape != (n, 1):
             raise ValueError(
                 'w has shape {S}. w must have shape ({N}, 1).'.format(S=w.shape, N=n))
+        if max_iter < 1:
+            raise ValueError('max_iter must be at least 1.')
 
-        w = np.sqrt(w)
-        for i in xrange(2):  # update this later
-            new_w = np.sqrt(update_func(cls.wls(x, y, w)))
-            if new_w.shape != w.shape:
-                print 'IRWLS update:', new_w.shape, w.shape
-                raise ValueError('New weights must have same shape.')
-            else:
-                w = new_w
+        if gram and not slow:
+            return cls._irwls_gram(x, y, update_func, n_blocks, w, separators, max_iter, tol)
 
+        w_deltas = []
+        for i in xrange(max_iter):
+            new_w = update_func(cls.wls(x, y, np.sqrt(w)))
+            w_deltas.append(cls._check_update(w, new_w))
+            w = new_w
+            if tol is not None and w_deltas[-1] < tol:
+                break
+
+        w = np.sqrt(w)
         x = cls._weight(x, w)
         y = cls._weight(y, w)
         if slow:
@@ -126,7 +166,79 @@ class IRWLS(object):
             jknife = jk.LstsqJackknifeFast(
                 x, y, n_blocks, separators=separators)
 
-        return jknife
+        return jknife, w_deltas
+
+    @classmethod
+    def _irwls_gram(cls, x, y, update_func, n_blocks, w, separators, max_iter, tol):
+        '''
+        IRWLS where every step is solved from the block values of X^T W X and X^T W Y, so
+        that no weighted copy of x is formed. Weights stay on the inverse CVF scale. Like the
+        lstsq path, the jackknife uses the weights from the last update.
+
+        '''
+        separators = jk.Jackknife(x, y, n_blocks, separators).separators
+        w_deltas = []
+        for i in xrange(max_iter):
+            new_w = update_func(cls.wls_gram(x, y, w, separators))
+            w_deltas.append(cls._check_update(w, new_w))
+            w = new_w
+            if tol is not None and w_deltas[-1] < tol:
+                break
+
+        if np.any(w <= 0):
+            raise ValueError('Weights must be > 0')
+        return jk.LstsqJackknifeFast(x, y, separators=separators, w=w), w_deltas
+
+    @classmethod
+    def _check_update(cls, w, new_w):
+        '''
+        Check the shape of updated weights and return the largest relative change. The
+        denominator is bounded away from zero, so that a zero weight (which the lstsq path
+        used to accept) doesn't raise FloatingPointError under np.seterr(divide='raise').
+
+        '''
+        if new_w.shape != w.shape:
+            print 'IRWLS update:', new_w.shape, w.shape
+            raise ValueError('New weights must have same shape.')
+
+        with np.errstate(over='ignore'):
+            delta = np.abs(new_w - w) / np.maximum(np.abs(w), np.finfo(float).tiny)
+        return float(np.max(delta))
+
+    @classmethod
+    def wls_gram(cls, x, y, w, s):
+        '''
+        Weighted least squares from the weighted Gram matrices X^T W X and X^T W Y,
+        accumulated over the blocks defined by s.
+
+        Parameters
+        ----------
+        x : np.matrix with shape (n, p)
+            Independent variable.
+        y : np.matrix with shape (n, 1)
+            Dependent variable.
+        w : np.matrix with shape (n, 1)
+            Regression weights (1/CVF scale).
+        s : list of ints
+            Block separators.
+
+        Returns
+        -------
+        coef : tuple with four elements (coefficients, None, None, None)
+            Coefficients with shape (p, 1), in the same position as in the output of
+            np.linalg.lstsq. Residuals, rank and singular values are not computed.
+
+        Raises
+        ------
+        ValueError :
+            If any element of w is <= 0.
+
+        '''
+        if np.any(w <= 0):
+            raise ValueError('Weights must be > 0')
+        xty, xtx = jk.LstsqJackknifeFast.block_values(x, y, s, w)
+        est = jk.LstsqJackknifeFast.block_values_to_est(xty, xtx)
+        return (est.T, None, None, None)
 
     @classmethod
     def wls(cls, x, y, w):
@@ -16,6 +16,8 @@ from __future__ import division
 import numpy as np
 from scipy.optimize import nnls
 np.seterr(divide='raise', invalid='raise')
+# max # of entries in the stack of delete X^T X matrices solved at once
+_SOLVE_BATCH_SIZE = 2**22
 
 
 def _check_shape(x, y):
@@ -113,24 +115,32 @@ class Jackknife(object):
         Parameters
         ----------
         pseudovalues : np.matrix pf floats with shape (n_blocks, p)
+            Pseudovalues. May have leading batch axes, i.e., shape (..., n_blocks, p), in
+            which case the outputs have the same leading axes.
 
         Returns
         -------
         jknife_est : np.matrix with shape (1, p)
-            Jackknifed estimate.
-        jknife_var : np.matrix with shape (1, p)
+            Jackknifed estimate (np.ndarray unless pseudovalues is an np.matrix).
+        jknife_var : np.ndarray with shape (1, p)
             Variance of jackknifed estimate.
-        jknife_se : np.matrix with shape (1, p)
+        jknife_se : np.ndarray with shape (1, p)
             Standard error of jackknifed estimate, equal to sqrt(jknife_var).
-        jknife_cov : np.matrix with shape (p, p)
+        jknife_cov : np.ndarray with shape (p, p)
             Covariance matrix of jackknifed estimate.
 
         '''
-        n_blocks = pseudovalues.shape[0]
-        jknife_cov = np.atleast_2d(np.cov(pseudovalues.T, ddof=1) / n_blocks)
-        jknife_var = np.atleast_2d(np.diag(jknife_cov))
-        jknife_se = np.atleast_2d(np.sqrt(jknife_var))
-        jknife_est = np.atleast_2d(np.mean(pseudovalues, axis=0))
+        is_matrix = isinstance(pseudovalues, np.matrix)
+        pseudovalues = np.asarray(pseudovalues)
+        n_blocks = pseudovalues.shape[-2]
+        jknife_est = np.mean(pseudovalues, axis=-2, keepdims=True)
+        dev = pseudovalues - jknife_est
+        # dev^T dev over the last two axes (np.matmul would need numpy >= 1.10)
+        jknife_cov = np.einsum('...ji,...jk->...ik', dev, dev) / (n_blocks - 1) / n_blocks
+        jknife_var = np.diagonal(jknife_cov, axis1=-2, axis2=-1)[..., np.newaxis, :]
+        jknife_se = np.sqrt(jknife_var)
+        if is_matrix:  # as with np.mean, the estimate of np.matrix pseudovalues is a matrix
+            jknife_est = np.matrix(jknife_est)
         return (jknife_est, jknife_var, jknife_se, jknife_cov)
 
     @classmethod
@@ -276,6 +286,11 @@ class LstsqJackknifeFast(Jackknife):
         Dependent variable.
     n_blocks : int
         Number of jackknife blocks
+    separators : list of ints, optional
+        Block separators.
+    w : np.matrix with shape (n, 1), optional
+        Regression weights. If given, the block values are the weighted Gram matrices X^T W X
+        and X^T W Y, so weighted copies of x and y are never formed.
 
     Attributes
     ----------
@@ -294,8 +309,8 @@ class LstsqJackknifeFast(Jackknife):
 
     Methods
     -------
-    block_values(x, y, n_blocks) :
-        Computes block values for the regression y~x.
+    block_values(x, y, s, w=None) :
+        Computes block values for the (weighted) regression y~x.
     block_values_to_est(block_values) :
         Computes whole-data estimate from block values.
     block_values_to_pseudovalues(block_values, est) :
@@ -303,9 +318,9 @@ class LstsqJackknifeFast(Jackknife):
 
     '''
 
-    def __init__(self, x, y, n_blocks=None, separators=None):
+    def __init__(self, x, y, n_blocks=None, separators=None, w=None):
         Jackknife.__init__(self, x, y, n_blocks, separators)
-        xty, xtx = self.block_values(x, y, self.separators)
+        xty, xtx = self.block_values(x, y, self.separators, w)
         self.est = self.block_values_to_est(xty, xtx)
         self.delete_values = self.block_values_to_delete_values(xty, xtx)
         self.pseudovalues = self.delete_values_to_pseudovalues(
@@ -314,7 +329,7 @@ class LstsqJackknifeFast(Jackknife):
             self.jknife(self.pseudovalues)
 
     @classmethod
-    def block_values(cls, x, y, s):
+    def block_values(cls, x, y, s, w=None):
         '''
         Compute block values.
 
@@ -324,33 +339,46 @@ class LstsqJackknifeFast(Jackknife):
             Independent variable.
         y : np.matrix with shape (n, 1)
             Dependent variable.
-        n_blocks : int
-            Number of jackknife blocks
         s : list of ints
             Block separators.
+        w : np.matrix with shape (n, 1), optional
+            Regression weights. Each row contributes w[i] * x[i]^T x[i] to X^T W X. Only one
+            block of weighted x is held in memory at a time.
 
         Returns
         -------
         xty_block_values : np.matrix with shape (n_blocks, p)
-            Block values of X^T Y.
+            Block values of X^T Y (X^T W Y if w is given).
         xtx_block_values : 3d np array with shape (n_blocks, p, p)
-            Block values of X^T X.
+            Block values of X^T X (X^T W X if w is given).
 
         Raises
         ------
         ValueError :
-            If x.shape[0] does not equal y.shape[0] or x and y are not 2D.
+            If x.shape[0] does not equal y.shape[0] or x and y are not 2D, or if w does not
+            have shape (n, 1).
 
         '''
         n, p = _check_shape(x, y)
+        if w is not None and w.shape != (n, 1):
+            raise ValueError(
+                'w has shape {S}. w must have shape ({N}, 1).'.format(S=w.shape, N=n))
         n_blocks = len(s) - 1
+        # slicing np.matrix is slow, and each block is a single BLAS call on the array. This
+        # is faster than segmented reductions over the blocks (benchmarks/block_values.py).
+        x, y = np.asarray(x), np.asarray(y)
         xtx_block_values = np.zeros((n_blocks, p, p))
         xty_block_values = np.zeros((n_blocks, p))
         for i in xrange(n_blocks):
-            xty_block_values[i, ...] = np.dot(
-                x[s[i]:s[i + 1], ...].T, y[s[i]:s[i + 1], ...]).reshape((1, p))
-            xtx_block_values[i, ...] = np.dot(
-                x[s[i]:s[i + 1], ...].T, x[s[i]:s[i + 1], ...])
+            xb = x[s[i]:s[i + 1], ...]
+            yb = y[s[i]:s[i + 1], 0]
+            if w is None:
+                wxb = xb
+            else:
+                wb = np.asarray(w)[s[i]:s[i + 1], ...]
+                wxb = xb * wb
+            xty_block_values[i, ...] = np.dot(wxb.T, yb)
+            xtx_block_values[i, ...] = np.dot(wxb.T, xb)
 
         return (xty_block_values, xtx_block_values)
 
@@ -414,14 +442,17 @@ class LstsqJackknifeFast(Jackknife):
 
         '''
         n_blocks, p = _check_shape_block(xty_block_values, xtx_block_values)
+        xty_block_values = np.asarray(xty_block_values)
         delete_values = np.zeros((n_blocks, p))
         xty_tot = np.sum(xty_block_values, axis=0)
         xtx_tot = np.sum(xtx_block_values, axis=0)
-        for j in xrange(n_blocks):
-            delete_xty = xty_tot - xty_block_values[j]
-            delete_xtx = xtx_tot - xtx_block_values[j]
-            delete_values[j, ...] = np.linalg.solve(
-                delete_xtx, delete_xty).reshape((1, p))
+        # solve the delete systems in batches of blocks with one batched solve per batch
+        step = max(1, _SOLVE_BATCH_SIZE // (p * p))
+        for j in xrange(0, n_blocks, step):
+            delete_xty = xty_tot - xty_block_values[j:j + step]
+            delete_xtx = xtx_tot - xtx_block_values[j:j + step]
+            delete_values[j:j + step] = np.linalg.solve(
+                delete_xtx, delete_xty[..., np.newaxis])[..., 0]
 
         return delete_values
 
@@ -442,6 +473,10 @@ class RatioJackknife(Jackknife):
     denom_delete_values: np.matrix with shape (n_blocks, p)
         Delete values for the denominator.
 
+    All three may have the same leading batch axes, i.e., shapes (..., 1, p) and
+    (..., n_blocks, p), to compute many ratio jackknives at once (e.g., rg for many pairs
+    of traits). The attributes then have the same leading axes.
+
     Methods
     -------
     delete_vals_to_pseudovalues(est, denom, num):
@@ -467,13 +502,13 @@ class RatioJackknife(Jackknife):
         if numer_delete_values.shape != denom_delete_values.shape:
             raise ValueError(
                 'numer_delete_values.shape != denom_delete_values.shape.')
-        if len(numer_delete_values.shape) != 2:
+        if len(numer_delete_values.shape) < 2:
             raise ValueError('Delete values must be matrices.')
-        if len(est.shape) != 2 or est.shape[0] != 1 or est.shape[1] != numer_delete_values.shape[1]:
+        if est.shape != numer_delete_values.shape[:-2] + (1, numer_delete_values.shape[-1]):
             raise ValueError(
                 'Shape of est does not match shape of delete values.')
 
-        self.n_blocks = numer_delete_values.shape[0]
+        self.n_blocks = numer_delete_values.shape[-2]
         self.est = est
         self.pseudovalues = self.delete_values_to_pseudovalues(self.est,
                                                                denom_delete_values, numer_delete_values)
@@ -494,6 +529,8 @@ class RatioJackknife(Jackknife):
         numer : np.matrix with shape (n_blocks, p)
             Numerator delete values.
 
+        All three may have leading batch axes (see RatioJackknife).
+
         Returns
         -------
         pseudovalues :
@@ -505,10 +542,9 @@ class RatioJackknife(Jackknife):
             If numer.shape != denom.shape.
 
         '''
-        n_blocks, p = denom.shape
-        pseudovalues = np.zeros((n_blocks, p))
-        for j in xrange(0, n_blocks):
-            pseudovalues[j, ...] = n_blocks * est - \
-                (n_blocks - 1) * numer[j, ...] / denom[j, ...]
+        if numer.shape != denom.shape:
+            raise ValueError('numer.shape != denom.shape.')
 
-        return pseudovalues
+        n_blocks = denom.shape[-2]
+        numer, denom = np.asarray(numer), np.asarray(denom)
+        return n_blocks * np.asarray(est) - (n_blocks - 1) * numer / denom
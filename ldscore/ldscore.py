@@ -1,6 +1,17 @@
 from __future__ import division
 import numpy as np
 import bitarray as ba
+from scipy import sparse
+from scipy.linalg import blas
+import os
+import time
+import hashlib
+import multiprocessing
+
+_SEGMENT_ARGS = None  # arguments shared with the worker processes of ldScoreVarBlocks
+_PACKED_DTYPE = np.dtype('<u8')  # words of packed .bed genotypes (32 individuals each)
+_EVEN_BITS = np.uint64(0x5555555555555555)
+_POPCOUNT_WORDS = 2**17  # size (in uint64 words) of the AND/popcount blocks of _and_popcount
 
 
 def getBlockLefts(coords, max_dist):
@@ -17,18 +28,25 @@ def getBlockLefts(coords, max_dist):
 
     Returns
     -------
-    block_left : 1D np.ndarray with same length as block_left
+    block_left : 1D integer np.ndarray with same length as coords
         block_left[j] :=  min{k | dist(j, k) < max_dist}.
 
     '''
-    M = len(coords)
-    j = 0
-    block_left = np.zeros(M)
-    for i in xrange(M):
-        while j < M and abs(coords[j] - coords[i]) > max_dist:
-            j += 1
-
-        block_left[i] = j
+    coords = np.asarray(coords)
+    block_left = np.searchsorted(coords, coords - max_dist, side='left')
+    # coords[j] - max_dist may round differently than coords[j] - coords[k], so move the
+    # (few) block lefts that disagree with dist(j, k) > max_dist
+    far = lambda j, k: coords[j] - coords[k] > max_dist
+    jj = np.nonzero(far(np.arange(len(coords)), block_left))[0]
+    while len(jj) > 0:
+        block_left[jj] += 1
+        jj = jj[far(jj, block_left[jj])]
+
+    jj = np.nonzero(block_left > 0)[0]
+    while len(jj) > 0:
+        jj = jj[np.logical_not(far(jj, block_left[jj] - 1))]
+        block_left[jj] -= 1
+        jj = jj[block_left[jj] > 0]
 
     return block_left
 
@@ -44,20 +62,12 @@ def block_left_to_right(block_left):
 
     Returns
     -------
-    block_right : 1D np.ndarray with same length as block_left
+    block_right : 1D integer np.ndarray with same length as block_left
         block_right[j] := max {k | block_left[k] <= j}
 
     '''
     M = len(block_left)
-    j = 0
-    block_right = np.zeros(M)
-    for i in xrange(M):
-        while j < M and block_left[j] <= i:
-            j += 1
-
-        block_right[i] = j
-
-    return block_right
+    return np.searchsorted(block_left, np.arange(M), side='right')
 
 
 class __GenotypeArrayInMemory__(object):
@@ -66,6 +76,7 @@ class __GenotypeArrayInMemory__(object):
     matrices, e.g., plink .bed files, etc
     '''
     def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
+        self.fname = fname
         self.m = len(snp_list.IDList)
         self.n = n
         self.keep_snps = keep_snps
@@ -118,11 +129,155 @@ class __GenotypeArrayInMemory__(object):
     def __filter_maf_(geno, m, n, maf):
         raise NotImplementedError
 
-    def ldScoreVarBlocks(self, block_left, c, annot=None):
-        '''Computes an unbiased estimate of L2(j) for j=1,..,M.'''
+    def nextSNPs(self, b, minorRef=None):
+        '''
+        Decodes the genotypes of the next b SNPs (with __decode__, which returns 9 for
+        missing genotypes) and returns an n x b matrix of floats of normalized genotypes,
+        where n := number of samples.
+
+        Parameters
+        ----------
+        b : int
+            Number of SNPs to return.
+        minorRef: bool, default None
+            Should we flip reference alleles so that the minor allele is the reference?
+            (This is useful for computing l1 w.r.t. minor allele).
+
+        Returns
+        -------
+        X : np.array with dtype float64 with shape (n, b), where n := number of samples
+            Matrix of genotypes normalized to mean zero and variance one. If minorRef is
+            not None, then the minor allele will be the positive allele (i.e., two copies
+            of the minor allele --> a positive number).
+
+        '''
+        b = self.__check_next__(b)
+        c = self._currentSNP
+        X = self.__decode__(c, b)
+        # mean-impute missing genotypes; for hard calls, sums of 0/1/2 are exact, so avg is too
+        ii = X != 9
+        X[np.logical_not(ii)] = 0
+        avg = np.sum(X, axis=1) / np.sum(ii, axis=1)
+        X = np.where(ii, X, avg[:, np.newaxis])
+        denom = np.std(X, axis=1)
+        denom[denom == 0] = 1
+        if minorRef is not None:
+            denom[np.array(self.freq[c:c+b]) > 0.5] *= -1
+
+        Y = np.ascontiguousarray(((X - avg[:, np.newaxis]) / denom[:, np.newaxis]).T)
+        self._currentSNP += b
+        return Y
+
+    def __check_next__(self, b):
+        try:
+            b = int(b)
+            if b <= 0:
+                raise ValueError("b must be > 0")
+        except TypeError:
+            raise TypeError("b must be an integer")
+
+        if self._currentSNP + b > self.m:
+            s = '{b} SNPs requested, {k} SNPs remain'
+            raise ValueError(s.format(b=b, k=(self.m-self._currentSNP)))
+
+        return b
+
+    def __decode__(self, c, b):
+        raise NotImplementedError
+
+    def ldScoreVarBlocks(self, block_left, c, annot=None, threads=1, precision='float64',
+            packed=False, checkpoint=None, resume=False):
+        '''
+        Computes an unbiased estimate of L2(j) for j=1,..,M. If threads > 1, the SNPs are
+        split into threads contiguous segments, which are computed in separate processes.
+        With precision='float32', the genotype window and correlation matrices are single
+        precision (the sums of correlations are still accumulated in double precision).
+        With packed=True, the window holds bit planes of the packed genotypes (4 bits per
+        individual) and the correlations are computed from popcounts (precision is
+        ignored). With checkpoint=(fname, interval), the state of the computation is
+        written to fname every interval seconds, and with resume=True, the computation
+        continues from fname if it exists (see __corSumVarBlocks__).
+        '''
         func = lambda x: self.__l2_unbiased__(x, self.n)
-        snp_getter = self.nextSNPs
-        return self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot)
+        snp_getter = self.nextSNPsPacked if packed else self.nextSNPs
+        if threads > 1:
+            if checkpoint is not None:
+                raise ValueError('Checkpoints require threads=1.')
+
+            return self.__corSumVarBlocksParallel__(block_left, c, func, snp_getter, annot,
+                threads, precision, packed=packed)
+
+        return self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot,
+            dtype=precision, packed=packed, checkpoint=checkpoint, resume=resume)
+
+    def tuneChunkSize(self, block_left, candidates=(50, 100, 200, 500, 1000, 2000),
+            precision='float64', packed=False):
+        '''
+        Times ldScoreVarBlocks with each chunk size in candidates on a segment of SNPs
+        (with the real n and windows) and returns the fastest. If the chromosome is too
+        short to time more than one candidate without computing the whole chromosome,
+        returns the smallest candidate.
+
+        Note that the LD Scores depend (slightly) on the chunk size, since the windows are
+        rounded to multiples of the chunk size.
+        '''
+        m = self.m
+        block_left = np.asarray(block_left)
+        max_window = int(np.max(np.arange(m) - block_left))
+        # start after the first block, which is computed differently
+        b = np.nonzero(block_left > 0)[0]
+        if len(b) == 0:
+            return min(candidates)
+
+        b = b[0]
+        candidates = sorted(candidates)
+        while len(candidates) > 1:
+            # the first block is rounded up to a multiple of c, so start at a multiple of
+            # the largest candidate, and time at least two chunks of each candidate
+            first = int(np.ceil(b / candidates[-1])*candidates[-1])
+            length = min(m - first, max(1000, 2*max_window))
+            if length >= 2*candidates[-1]:
+                break
+
+            candidates.pop()
+
+        if len(candidates) < 2:
+            return candidates[0]
+
+        func = lambda x: self.__l2_unbiased__(x, self.n)
+        snp_getter = self.nextSNPsPacked if packed else self.nextSNPs
+        times = []
+        for c in candidates:
+            self._currentSNP = 0
+            t = time.time()
+            self.__corSumVarBlocks__(block_left, c, func, snp_getter,
+                snps=(first, first + length), dtype=precision, packed=packed)
+            times.append(time.time() - t)
+
+        self._currentSNP = 0
+        return candidates[int(np.argmin(times))]
+
+    def ldScoreBand(self, block_left, c, annot=None, threads=1, precision='float64',
+            packed=False):
+        '''
+        Computes the band of unbiased r^2 between SNPs in the same window that
+        ldScoreVarBlocks sums over. Returns a tuple (l2, band), where l2 is the LD Score for
+        the (dense) annot, computed from the unrounded correlations exactly as by
+        ldScoreVarBlocks, and band is the lower triangle (including the diagonal) of the band
+        as a scipy.sparse CSR matrix with entries rounded to float16 precision. band_cor_sum(band, annot) then
+        gives the partitioned LD Score for any annot without reading the genotypes again.
+        '''
+        func = lambda x: self.__l2_unbiased__(x, self.n)
+        snp_getter = self.nextSNPsPacked if packed else self.nextSNPs
+        band = []
+        if threads > 1:
+            l2 = self.__corSumVarBlocksParallel__(block_left, c, func, snp_getter, annot,
+                threads, precision, band=band, packed=packed)
+        else:
+            l2 = self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot,
+                dtype=precision, band=band, packed=packed)
+
+        return (l2, _join_bands(band, self.m))
 
     def ldScoreBlockJackknife(self, block_left, c, annot=None, jN=10):
         func = lambda x: np.square(x)
@@ -135,7 +290,8 @@ class __GenotypeArrayInMemory__(object):
         return sq - (1-sq) / denom
 
     # general methods for calculating sums of Pearson correlation coefficients
-    def __corSumVarBlocks__(self, block_left, c, func, snp_getter, annot=None):
+    def __corSumVarBlocks__(self, block_left, c, func, snp_getter, annot=None, snps=None,
+            dtype='float64', band=None, packed=False, checkpoint=None, resume=False):
         '''
         Parameters
         ----------
@@ -154,8 +310,32 @@ class __GenotypeArrayInMemory__(object):
         snp_getter : function(int)
             The method to be used to get the next SNPs (normalized genotypes? Normalized
             genotypes with the minor allele as reference allele? etc)
-        annot: numpy array with shape (m,n_a)
-            SNP annotations.
+        annot: numpy array or scipy.sparse matrix with shape (m,n_a)
+            SNP annotations. If annot is sparse, only the correlations with SNPs that have
+            a nonzero annotation are computed.
+        snps : (int, int), optional
+            If set to (first, last), only chunks that add to cor_sum[first:last] are
+            computed, and only the genotypes they need are read. The other rows of cor_sum
+            are not valid. Must be called with _currentSNP = 0.
+        dtype : str, default 'float64'
+            dtype of the genotype window and of the matrices of correlations passed to func.
+            cor_sum is always float64.
+        band : list, optional
+            If set, a _Band holding the lower triangle of the matrix of func(correlations)
+            in rows first, ..., last-1 is appended to band. annot must be dense.
+        packed : bool, default False
+            If True, snp_getter returns the packed .bed genotypes of the SNPs as columns of
+            little-endian uint64 words (see nextSNPsPacked). The window holds the bit planes
+            and counts of each SNP (see _packed_planes), computed once as it is read, and the
+            correlations are computed from popcounts of the planes. dtype is ignored.
+        checkpoint : (str, float), optional
+            If set to (fname, interval), cor_sum, the window of genotypes and the position
+            of the next chunk are written to fname (with _write_checkpoint) every interval
+            seconds. Cannot be combined with snps or band. A checkpoint is only resumed if
+            the size and modification time of the genotype file are unchanged.
+        resume : bool, default False
+            If True and the checkpoint file exists, continue from it instead of starting
+            from SNP 0. The results are identical to an uninterrupted run.
 
         Returns
         -------
@@ -164,6 +344,20 @@ class __GenotypeArrayInMemory__(object):
 
         '''
         m, n = self.m, self.n
+        first, last = snps if snps is not None else (0, m)
+        if packed:
+            # the window holds the bit planes and per-SNP counts of each SNP
+            valid = _packed_valid(n)
+            get_packed = snp_getter
+            snp_getter = lambda b: _packed_planes(get_packed(b), valid)
+            cor = lambda X, Y: _packed_cor(X, Y, n)
+            gram = lambda X: _packed_cor(X, X, n)
+            n_rows, dtype = 2*len(valid) + 3, _PACKED_DTYPE
+        else:
+            cor = lambda X, Y: np.dot(X.T, Y / n)
+            gram = lambda X: _gram(X, n)
+            n_rows = n
+
         block_sizes = np.array(np.arange(m) - block_left)
         block_sizes = np.ceil(block_sizes / c)*c
         if annot is None:
@@ -175,6 +369,17 @@ class __GenotypeArrayInMemory__(object):
 
         n_a = annot.shape[1]  # number of annotations
         cor_sum = np.zeros((m, n_a))
+        is_sparse = sparse.issparse(annot)
+        if is_sparse:
+            annot = sparse.csr_matrix(annot)
+            nz_rows = np.diff(annot.indptr) > 0
+        else:
+            nz_rows = np.asarray(np.any(annot != 0, axis=1)).reshape(m)
+        # nz[j] := number of SNPs with a nonzero annotation among SNPs 0, ..., j-1
+        nz = np.r_[0, np.cumsum(nz_rows)]
+        if is_sparse:
+            # the nonzero rows of SNPs j, ..., k-1 are rows nz[j], ..., nz[k]-1 of annot_nz
+            annot_nz = annot[np.nonzero(nz_rows)[0], :]
         # b = index of first SNP for which SNP 0 is not included in LD Score
         b = np.nonzero(block_left > 0)
         if np.any(b):
@@ -185,73 +390,502 @@ class __GenotypeArrayInMemory__(object):
         if b > m:
             c = 1
             b = m
+        # the window of standardized genotypes is kept in a ring buffer: SNP j is written to
+        # columns j % W and j % W + W, so that any W consecutive SNPs are a single column
+        # slice of A_buf (a strided view, not a copy; the rows are not contiguous). Storing
+        # every SNP twice doubles the memory of the window (n x 2W instead of n x W).
+        # W is a multiple of c, so chunks never wrap around the buffer.
+        W = int(np.ceil(max(b, np.max(block_sizes) + c) / c)*c)
+        A_buf = np.zeros((n_rows, 2*W), dtype=dtype)
         l_A = 0  # l_A := index of leftmost SNP in matrix A
-        A = snp_getter(b)
-        rfuncAB = np.zeros((b, c))
-        rfuncBB = np.zeros((c, c))
-        # chunk inside of block
-        for l_B in xrange(0, b, c):  # l_B := index of leftmost SNP in matrix B
-            B = A[:, l_B:l_B+c]
-            np.dot(A.T, B / n, out=rfuncAB)
-            rfuncAB = func(rfuncAB)
-            cor_sum[l_A:l_A+b, :] += np.dot(rfuncAB, annot[l_B:l_B+c, :])
+        n_read = 0  # n_read := index of the next SNP to be read
+        resumed = False
+        if checkpoint is not None:
+            if snps is not None or band is not None:
+                raise ValueError('Checkpoints cannot be combined with snps or band.')
+
+            ckpt_fname, ckpt_interval = checkpoint
+            ckpt_key = _checkpoint_key(self.fname, self.kept_snps, self.keep_indivs,
+                block_left, c, annot, dtype, packed)
+            ckpt_time = time.time()
+            if resume and os.path.exists(ckpt_fname):
+                b, n_read, self._currentSNP = _read_checkpoint(ckpt_fname, ckpt_key, cor_sum,
+                    A_buf)
+                resumed = True
+
+        if band is not None:
+            band.append(_Band(_band_row_left(block_sizes, b, c, m), first, last))
+            band = band[-1]
+
+        if first < b and not resumed:
+            A_buf[:, 0:b] = snp_getter(b)
+            A_buf[:, W:W+b] = A_buf[:, 0:b]
+            A = A_buf[:, 0:b]
+            # chunk inside of block
+            for l_B in xrange(0, b, c):  # l_B := index of leftmost SNP in matrix B
+                B = A[:, l_B:l_B+c]
+                if is_sparse:
+                    kB = l_B + np.nonzero(nz_rows[l_B:l_B+c])[0]
+                    if len(kB) > 0:
+                        rfunc = func(cor(A, A[:, kB]))
+                        cor_sum[l_A:l_A+b, :] += _dot_annot(rfunc,
+                            annot_nz[nz[l_B]:nz[l_B+c], :])
+                else:
+                    rfunc = func(cor(A, B))
+                    cor_sum[l_A:l_A+b, :] += np.dot(rfunc, annot[l_B:l_B+c, :])
+                    if band is not None:
+                        band.add(rfunc, l_A, l_B)
+
+            n_read = b
+
         # chunk to right of block
         b0 = b
         md = int(c*np.floor(m/c))
         end = md + 1 if md != m else md
         for l_B in xrange(b0, end, c):
-            # check if the annot matrix is all zeros for this block + chunk
-            # this happens w/ sparse categories (i.e., pathways)
+            if checkpoint is not None and time.time() - ckpt_time > ckpt_interval:
+                _write_checkpoint(ckpt_fname, ckpt_key, cor_sum, A_buf, l_B, n_read,
+                    self._currentSNP)
+                ckpt_time = time.time()
+
             # update the block
-            old_b = b
+            # block_size can't increase more than c, so the SNPs in the new block are always
+            # among the last W SNPs read
             b = int(block_sizes[l_B])
-            if l_B > b0 and b > 0:
-                # block_size can't increase more than c
-                # block_size can't be less than c unless it is zero
-                # both of these things make sense
-                A = np.hstack((A[:, old_b-b+c:old_b], B))
-                l_A += old_b-b+c
-            elif l_B == b0 and b > 0:
-                A = A[:, b0-b:b0]
-                l_A = b0-b
-            elif b == 0:  # no SNPs to left in window, e.g., after a sequence gap
-                A = np.array(()).reshape((n, 0))
-                l_A = l_B
+            l_A = l_B - b
             if l_B == md:
                 c = m - md
-                rfuncAB = np.zeros((b, c))
-                rfuncBB = np.zeros((c, c))
-            if b != old_b:
-                rfuncAB = np.zeros((b, c))
-
-            B = snp_getter(c)
-            p1 = np.all(annot[l_A:l_A+b, :] == 0)
-            p2 = np.all(annot[l_B:l_B+c, :] == 0)
-            if p1 and p2:
+
+            if l_B + c <= first or l_A >= last:
+                continue  # this chunk only adds to SNPs outside of first, ..., last-1
+
+            # check if the annot matrix is all zeros for this block + chunk
+            # this happens w/ sparse categories (i.e., pathways). The genotypes of the
+            # skipped chunk are only read if the block of a later chunk needs them.
+            if nz[l_B+c] == nz[l_A] and band is None:
+                continue
+
+            if n_read < l_B:
+                # skip to the block of the first chunk that is computed
+                l = max(l_A, n_read)
+                self._currentSNP += l - n_read
+                if l < l_B:
+                    ii = np.arange(l, l_B) % W
+                    A_buf[:, ii] = snp_getter(l_B - l)
+                    A_buf[:, ii + W] = A_buf[:, ii]
+
+            n_read = l_B + c
+            B = np.asarray(snp_getter(c), dtype=dtype)
+            A_buf[:, l_B % W:l_B % W + c] = B
+            A_buf[:, l_B % W + W:l_B % W + W + c] = B
+            A = A_buf[:, l_A % W:l_A % W + b]
+            if is_sparse:
+                # only the columns of A and B with nonzero annotations are multiplied
+                kA = np.nonzero(nz_rows[l_A:l_B])[0]
+                kB = np.nonzero(nz_rows[l_B:l_B+c])[0]
+                if len(kB) > 0:
+                    annot_B = annot_nz[nz[l_B]:nz[l_B+c], :]
+                    rfunc = func(cor(A, B[:, kB]))
+                    cor_sum[l_A:l_A+b, :] += _dot_annot(rfunc, annot_B)
+                    rfunc = func(cor(B, B[:, kB]))
+                    cor_sum[l_B:l_B+c, :] += _dot_annot(rfunc, annot_B)
+                if len(kA) > 0:
+                    rfunc = func(cor(B, A[:, kA]))
+                    cor_sum[l_B:l_B+c, :] += _dot_annot(rfunc, annot_nz[nz[l_A]:nz[l_B], :])
+
                 continue
 
-            np.dot(A.T, B / n, out=rfuncAB)
-            rfuncAB = func(rfuncAB)
+            rfuncAB = func(cor(A, B))
             cor_sum[l_A:l_A+b, :] += np.dot(rfuncAB, annot[l_B:l_B+c, :])
             cor_sum[l_B:l_B+c, :] += np.dot(annot[l_A:l_A+b, :].T, rfuncAB).T
-            np.dot(B.T, B / n, out=rfuncBB)
-            rfuncBB = func(rfuncBB)
+            rfuncBB = func(gram(B))
             cor_sum[l_B:l_B+c, :] += np.dot(rfuncBB, annot[l_B:l_B+c, :])
+            if band is not None:
+                band.add(rfuncAB.T, l_B, l_A)
+                band.add(rfuncBB, l_B, l_B)
 
         return cor_sum
 
+    def __corSumVarBlocksParallel__(self, block_left, c, func, snp_getter, annot, threads,
+            dtype='float64', band=None, packed=False):
+        '''
+        Splits the SNPs into threads contiguous segments and computes the rows of cor_sum
+        for each segment in a separate (forked) process with __corSumVarBlocks__(...,
+        snps=segment). Each process reads the genotypes of its segment plus a halo of the
+        windows that overlap it, and adds up exactly the same products in the same order
+        as the serial computation, so the results are identical. If band is a list, the
+        _Band computed by each process is appended to it.
+        '''
+        global _SEGMENT_ARGS
+        bounds = np.linspace(0, self.m, min(threads, self.m) + 1).astype(int)
+        segments = zip(bounds[:-1], bounds[1:])
+        _SEGMENT_ARGS = (self, block_left, c, func, snp_getter, annot, dtype,
+            band is not None, packed)
+        pool = multiprocessing.Pool(len(segments))
+        try:
+            cor_sums = pool.map(_cor_sum_segment, segments)
+        finally:
+            pool.close()
+            pool.join()
+            _SEGMENT_ARGS = None
+
+        self._currentSNP = self.m
+        if band is not None:
+            cor_sums, bands = zip(*cor_sums)
+            for x in bands:
+                band.extend(x)
+
+        return np.vstack(cor_sums)
+
+
+def _gram(B, n):
+    '''
+    Returns np.dot(B.T, B) / n. Only the upper triangle is computed (with BLAS syrk), and
+    then copied to the lower triangle.
+    '''
+    syrk = blas.get_blas_funcs('syrk', (B,))
+    BB = syrk(1 / n, B.T)  # B.T is Fortran-contiguous, so BLAS gets B without a copy
+    return np.triu(BB) + np.triu(BB, 1).T
+
+
+def _popcount(x, t=None):
+    '''
+    Replaces each element of the uint64 array x with the number of bits set in it, in place.
+    t is a scratch array with the shape of x (allocated if None).
+    '''
+    if t is None:
+        t = np.empty_like(x)
+    np.right_shift(x, np.uint64(1), out=t)
+    t &= _EVEN_BITS
+    x -= t
+    np.right_shift(x, np.uint64(2), out=t)
+    t &= np.uint64(0x3333333333333333)
+    x &= np.uint64(0x3333333333333333)
+    x += t
+    np.right_shift(x, np.uint64(4), out=t)
+    x += t
+    x &= np.uint64(0x0f0f0f0f0f0f0f0f)
+    x *= np.uint64(0x0101010101010101)
+    x >>= np.uint64(56)
+    return x
+
+
+def _and_popcount(P, Q, jj=None, kk=None):
+    '''
+    Returns the matrix of sum_w popcount(P[w, j] & Q[w, k]) over the rows w of the uint64
+    arrays P and Q, for the columns j in jj and k in kk (all columns if None), as float64.
+    The pairs of columns are ANDed in blocks, so the temporaries hold at most
+    _POPCOUNT_WORDS words (or one pair, if that is larger), and columns of P and Q are only
+    gathered a block at a time.
+    '''
+    n_words = P.shape[0]
+    jj = np.arange(P.shape[1]) if jj is None else jj
+    kk = np.arange(Q.shape[1]) if kk is None else kk
+    out = np.zeros((len(jj), len(kk)))
+    if n_words == 0 or len(jj) == 0 or len(kk) == 0:
+        return out
+
+    kb = max(1, min(len(kk), _POPCOUNT_WORDS // n_words))
+    jb = max(1, min(len(jj), _POPCOUNT_WORDS // (n_words*kb)))
+    buf = np.empty(n_words*jb*kb, dtype=_PACKED_DTYPE)
+    tmp = np.empty_like(buf)
+    for k in xrange(0, len(kk), kb):
+        Qk = Q[:, kk[k:k+kb], np.newaxis]
+        for j in xrange(0, len(jj), jb):
+            Pj = P[:, jj[j:j+jb]]
+            size = n_words*Pj.shape[1]*Qk.shape[1]
+            T = buf[0:size].reshape((n_words, Qk.shape[1], Pj.shape[1]))
+            np.bitwise_and(Qk, Pj[:, np.newaxis, :], out=T)
+            _popcount(T, tmp[0:size].reshape(T.shape))
+            out[j:j+jb, k:k+kb] = np.sum(T, axis=0).T
+
+    return out
+
+
+def _packed_valid(n):
+    '''
+    Returns the words (see nextSNPsPacked) with the low bit of the 2-bit code of each of
+    the n individuals set, and the bits of the pad individuals cleared.
+    '''
+    n_words = ((n + 3) // 4 + 7) // 8
+    valid = np.zeros(8*n_words, dtype='uint8')
+    valid[0:n // 4] = 0x55
+    if n % 4 != 0:
+        valid[n // 4] = 0x55 & ((1 << 2*(n % 4)) - 1)
+
+    return valid.view(_PACKED_DTYPE)
+
+
+def _packed_planes(X, valid):
+    '''
+    Converts packed genotypes X (as returned by nextSNPsPacked) into the columns that the
+    LD window holds with packed=True. With the .bed codes (high bit first) 00 -> 0,
+    10 -> 1, 11 -> 2 and 01 -> missing, let a := [genotype >= 1], b := [genotype == 2] and
+    o := [genotype is not missing]. For X with n_words rows, rows 0, ..., n_words-1 of the
+    result hold G, with a in the even bits and b in the odd bits (so a missing genotype
+    counts as 0), rows n_words, ..., 2*n_words-1 hold O2, with o in both bits of each
+    individual, and the last three rows hold the number of nonmissing genotypes, the sum
+    of the genotypes and the sum of the squared genotypes of each SNP. The planes are
+    computed once per SNP, when it enters the window.
+    '''
+    n_words, b = X.shape
+    P = np.empty((2*n_words + 3, b), dtype=_PACKED_DTYPE)
+    G, O2 = P[0:n_words], P[n_words:2*n_words]
+    one = np.uint64(1)
+    low = X & _EVEN_BITS
+    high = (X >> one) & _EVEN_BITS
+    both = low & high  # b
+    np.bitwise_or(high, both << one, out=G)
+    np.bitwise_or(~low, high, out=O2)
+    O2 &= valid[:, np.newaxis]
+    P[2*n_words] = np.sum(_popcount(O2.copy()), axis=0)
+    O2 |= O2 << one
+    P[2*n_words + 1] = np.sum(_popcount(G.copy()), axis=0)
+    P[2*n_words + 2] = P[2*n_words + 1] + 2*np.sum(_popcount(both), axis=0)
+    return P
+
+
+def _packed_cor(X, Y, n):
+    '''
+    Returns the n-normalized correlations np.dot(x.T, y) / n between the standardized,
+    mean-imputed genotypes x and y of the SNPs in the columns of X and Y (as returned by
+    _packed_planes). For SNPs j and k, with O := individuals with nonmissing genotypes at
+    both SNPs,
+
+        n * sd_j * sd_k * r_jk = sum_O g_j g_k - mu_k sum_O g_j - mu_j sum_O g_k
+                                 + mu_j mu_k |O|,
+
+    and each sum over O is a popcount of the AND of bit planes of the two SNPs. The sums
+    over O that involve a SNP with no missing genotypes are its per-SNP sums, so the
+    planes are only ANDed for the SNPs with missing genotypes.
+    '''
+    n_words = (X.shape[0] - 3) // 2
+    stats = []
+    for Z in (X, Y):
+        n_obs, s1, s2 = [Z[2*n_words + i].astype('float64') for i in xrange(3)]
+        mu = np.zeros(len(n_obs))
+        ii = n_obs > 0
+        mu[ii] = s1[ii] / n_obs[ii]
+        sd = np.sqrt(np.maximum(s2 - s1*mu, 0) / n)
+        sd[sd == 0] = 1
+        miss = np.nonzero(n_obs < n)[0]
+        stats.append((Z[0:n_words], Z[n_words:2*n_words], n_obs, s1, mu, sd, miss))
+
+    (GX, O2X, nX, s1X, muX, sdX, mX), (GY, O2Y, nY, s1Y, muY, sdY, mY) = stats
+    one = np.uint64(1)
+    GsY = ((GY & _EVEN_BITS) << one) | ((GY >> one) & _EVEN_BITS)  # b even, a odd
+    gg = _and_popcount(GX, GY) + _and_popcount(GX, GsY)
+    # gx[j, k] = sum of g_j over the individuals with nonmissing genotypes at SNP k, etc.
+    gx = np.tile(s1X[:, np.newaxis], (1, len(nY)))
+    gx[:, mY] = _and_popcount(GX, O2Y, kk=mY)
+    gy = np.tile(s1Y, (len(nX), 1))
+    gy[mX, :] = _and_popcount(O2X, GY, jj=mX)
+    oo = np.minimum.outer(nX, nY)
+    if len(mX) > 0 and len(mY) > 0:
+        oo[np.ix_(mX, mY)] = _and_popcount(O2X, O2Y & _EVEN_BITS, jj=mX, kk=mY)
+
+    cov = gg - gx*muY - muX[:, np.newaxis]*gy + np.outer(muX, muY)*oo
+    return cov / (n*np.outer(sdX, sdY))
+
+
+def _packed_rows(n_rows, n_bytes):
+    '''
+    Returns an uninitialized little-endian bitarray with n_rows rows of n_bytes bytes of
+    packed .bed genotypes, together with a writable (n_rows, n_bytes) uint8 view of its
+    buffer, so that the rows can be filled without building an intermediate bytes copy.
+    '''
+    y = ba.bitarray(8*n_rows*n_bytes, endian="little")
+    return y, np.frombuffer(y, dtype='uint8').reshape((n_rows, n_bytes))
+
+
+def _subset_packed(G, keep_indivs, nru):
+    '''
+    Returns the packed .bed genotypes of the individuals keep_indivs, with nru // 4 bytes
+    per SNP, from the packed genotypes G (a uint8 array with one row per SNP). The pad bits
+    are set to zero.
+    '''
+    shifts = np.array([0, 2, 4, 6], dtype='uint8')
+    codes = ((G[:, :, np.newaxis] >> shifts) & 3).reshape((len(G), -1))[:, keep_indivs]
+    X = np.zeros((len(G), nru), dtype='uint8')
+    X[:, 0:len(keep_indivs)] = codes
+    X = X.reshape((len(G), nru // 4, 4)) << shifts
+    return np.bitwise_or.reduce(X, axis=2)
+
+
+def _checkpoint_key(geno_fname, kept_snps, keep_indivs, block_left, c, annot, dtype, packed):
+    '''
+    Returns a checksum of the genotype file (its name, size and modification time), the SNP
+    and individual filters, and the arguments of __corSumVarBlocks__ that a checkpoint
+    depends on.
+    '''
+    st = os.stat(geno_fname)
+    h = hashlib.sha1()
+    h.update(repr((os.path.abspath(geno_fname), st.st_size, st.st_mtime)))
+    h.update(repr((c, str(dtype), packed, annot.shape)))
+    h.update(np.asarray(kept_snps, dtype='int64').tostring())
+    if keep_indivs is not None:
+        h.update(np.asarray(keep_indivs, dtype='int64').tostring())
+    h.update(np.asarray(block_left, dtype='int64').tostring())
+    if sparse.issparse(annot):
+        for x in (annot.data, annot.indices, annot.indptr):
+            h.update(np.ascontiguousarray(x).tostring())
+    else:
+        h.update(np.ascontiguousarray(annot, dtype='float64').tostring())
+
+    return h.hexdigest()
+
+
+def _write_checkpoint(fname, key, cor_sum, A_buf, l_B, n_read, current_snp):
+    '''
+    Writes the state of __corSumVarBlocks__ before the chunk starting at SNP l_B to fname.
+    Only the first half of the ring buffer A_buf is saved, since the second half is a copy.
+    The file is written under a temporary name and then renamed, so an interrupted write
+    leaves the previous checkpoint intact.
+    '''
+    tmp_fname = fname + '.tmp'
+    W = A_buf.shape[1] // 2
+    with open(tmp_fname, 'wb') as f:
+        np.savez_compressed(f, key=key, cor_sum=cor_sum, A_buf=A_buf[:, :W],
+            pos=np.array([l_B, n_read, current_snp], dtype='int64'))
+
+    os.rename(tmp_fname, fname)
+
+
+def _read_checkpoint(fname, key, cor_sum, A_buf):
+    '''
+    Reads a checkpoint written by _write_checkpoint into cor_sum and A_buf, and returns
+    (l_B, n_read, current_snp).
+    '''
+    x = np.load(fname)
+    W = A_buf.shape[1] // 2
+    if str(x['key']) != key or x['cor_sum'].shape != cor_sum.shape or \
+            x['A_buf'].shape != (A_buf.shape[0], W):
+        raise ValueError('Checkpoint {F} is from a different computation.'.format(F=fname))
+
+    cor_sum[:] = x['cor_sum']
+    A_buf[:, :W] = x['A_buf']
+    A_buf[:, W:] = A_buf[:, :W]
+    return tuple(int(i) for i in x['pos'])
+
+
+def _dot_annot(rfunc, annot):
+    '''Returns np.dot(rfunc, annot) for a dense or scipy.sparse annot.'''
+    if sparse.issparse(annot):
+        return annot.T.dot(rfunc.T).T
+    else:
+        return np.dot(rfunc, annot)
+
+
+def _cor_sum_segment(snps):
+    '''Computes cor_sum[first:last] in a worker process forked by __corSumVarBlocksParallel__.'''
+    geno_array, block_left, c, func, snp_getter, annot, dtype, get_band, packed = _SEGMENT_ARGS
+    geno_array._currentSNP = 0  # a worker may be handed more than one segment
+    band = [] if get_band else None
+    cor_sum = geno_array.__corSumVarBlocks__(block_left, c, func, snp_getter, annot, snps,
+        dtype, band, packed)
+    if get_band:
+        return (cor_sum[snps[0]:snps[1], :], band)
+
+    return cor_sum[snps[0]:snps[1], :]
+
+
+def _band_row_left(block_sizes, b, c, m):
+    '''
+    Returns row_left, where row_left[i] is the leftmost SNP whose correlation with SNP i is
+    computed by __corSumVarBlocks__ (b and c as after the first block there): 0 for the SNPs
+    in the first block, and the left end of the block of the chunk of SNP i after that.
+    '''
+    row_left = np.zeros(m, dtype=np.int64)
+    if b < m:
+        l_B = b + (np.arange(b, m) - b) // c * c  # leftmost SNP of the chunk of each SNP
+        row_left[b:] = l_B - block_sizes[l_B].astype(np.int64)
+
+    return row_left
+
+
+class _Band(object):
+    '''
+    Lower triangle (including the diagonal) of rows first, ..., last-1 of the band, stored as
+    the indptr, indices and data arrays of a CSR matrix. Row i holds columns row_left[i], ...,
+    i, so the arrays are allocated once with their final size and the chunks of
+    __corSumVarBlocks__ fill them in place. The entries are rounded to float16 precision
+    (and stored as float32, which scipy.sparse supports).
+    '''
+    def __init__(self, row_left, first, last):
+        self.first, self.last = first, last
+        self.row_left = row_left
+        nnz = np.arange(first, last) - row_left[first:last] + 1
+        self.indptr = np.zeros(last - first + 1, dtype=np.int64)
+        np.cumsum(nnz, out=self.indptr[1:])
+        self.indices = np.zeros(self.indptr[-1], dtype=np.int32)
+        self.data = np.zeros(self.indptr[-1], dtype=np.float32)
+
+    def add(self, rfunc, l_A, l_B):
+        '''
+        Stores the entries of rfunc (the block of rows l_A, ... and columns l_B, ... of the
+        band) on or below the diagonal and in rows first, ..., last-1.
+        '''
+        i = np.arange(max(l_A, self.first), min(l_A + rfunc.shape[0], self.last))
+        j = np.arange(l_B, l_B + rfunc.shape[1])
+        ii, jj = np.nonzero((i[:, None] >= j) & (j >= self.row_left[i][:, None]))
+        ii = i[ii]
+        pos = self.indptr[ii - self.first] + (jj + l_B - self.row_left[ii])
+        self.indices[pos] = jj + l_B
+        self.data[pos] = rfunc[ii - l_A, jj].astype(np.float16)
+
+
+def _join_bands(bands, m):
+    '''Joins the _Bands of consecutive rows returned by __corSumVarBlocks__ into one CSR matrix.'''
+    if len(bands) == 1:
+        indptr, indices, data = bands[0].indptr, bands[0].indices, bands[0].data
+    else:
+        offsets = np.cumsum([0] + [x.indptr[-1] for x in bands[:-1]])
+        indptr = np.concatenate([bands[0].indptr[:1]] +
+            [x.indptr[1:] + o for x, o in zip(bands, offsets)])
+        indices = np.concatenate([x.indices for x in bands])
+        data = np.concatenate([x.data for x in bands])
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(m, m))
+
+
+def band_cor_sum(band, annot=None):
+    '''
+    Computes cor_sum from the band returned by ldScoreBand.
+
+    Parameters
+    ----------
+    band : scipy.sparse matrix with shape (M, M)
+        Lower triangle (including the diagonal) of the band of func(correlations).
+    annot : np.ndarray with shape (M, num_annots), optional
+        SNP annotations. If None, a single all-ones annotation is used.
+
+    Returns
+    -------
+    cor_sum : np.ndarray with shape (M, num_annots)
+        Estimates.
+
+    '''
+    m = band.shape[0]
+    if annot is None:
+        annot = np.ones((m, 1))
+    elif annot.shape[0] != m:
+        raise ValueError('Incorrect number of SNPs in annot')
+
+    band = sparse.csr_matrix(band, dtype=np.float32)
+    diag = band.diagonal().reshape((m, 1))
+    cor_sum = band.dot(annot) + band.T.dot(annot) - np.multiply(diag, annot)
+    return np.asarray(cor_sum, dtype=np.float64)
+
 
 class PlinkBEDFile(__GenotypeArrayInMemory__):
     '''
     Interface for Plink .bed format
     '''
     def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
-        self._bedcode = {
-            2: ba.bitarray('11'),
-            9: ba.bitarray('10'),
-            1: ba.bitarray('01'),
-            0: ba.bitarray('00')
-            }
+        # lookup table from a packed .bed byte to the genotypes of its four individuals
+        # (low-order bits first): 00 -> 0, 10 -> 1, 11 -> 2, 01 -> 9 (missing)
+        self._bedcode = np.array([[(0, 9, 1, 2)[(byte >> 2*k) & 3] for k in xrange(4)]
+                                  for byte in xrange(256)], dtype='float64')
 
         __GenotypeArrayInMemory__.__init__(self, fname, n, snp_list, keep_snps=keep_snps,
             keep_indivs=keep_indivs, mafMin=mafMin)
@@ -289,15 +923,25 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
             raise IOError(s.format(n1=real_len, n2=exp_len))
 
     def __filter_indivs__(self, geno, keep_indivs, m, n):
+        '''
+        Unpacks the genotypes of a few MB worth of SNPs at a time into 2-bit codes, keeps
+        the columns of keep_indivs and packs them again. The pad bits are set to zero. geno
+        is read through an (m, nru / 4) uint8 view of its buffer, and each block is written
+        straight into a preallocated bitarray, so the genotypes are never copied whole.
+        '''
         n_new = len(keep_indivs)
         e = (4 - n_new % 4) if n_new % 4 != 0 else 0
         nru_new = n_new + e
         nru = self.nru
-        z = ba.bitarray(m*2*nru_new, endian="little")
-        for e, i in enumerate(keep_indivs):
-            z[2*e::2*nru_new] = geno[2*i::2*nru]
-            z[2*e+1::2*nru_new] = geno[2*i+1::2*nru]
-
+        G = np.frombuffer(geno, dtype='uint8').reshape((m, nru // 4))
+        z, Z = _packed_rows(m, nru_new // 4)
+        # _subset_packed makes a few copies of the 2-bit codes (one byte per individual) of
+        # each block, so the blocks hold 8 MB of codes
+        chunk_size = max(1, 2**23 // nru)
+        for i in xrange(0, m, chunk_size):
+            Z[i:i+chunk_size, :] = _subset_packed(G[i:i+chunk_size], keep_indivs, nru_new)
+
+        del G, Z  # views of the buffers of geno and z
         self.nru = nru_new
         return (z, m, n_new)
 
@@ -329,86 +973,281 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
 
         Why does bitarray not have >> ????
 
+        The counts are computed from the packed bytes of all SNPs at once (a few MB at a
+        time), with lookup tables from a byte to the counts of its four genotypes. The
+        pad bits at the end of each SNP are masked out. geno is read through a uint8 view of
+        its buffer, and the kept SNPs are copied a chunk at a time into a preallocated
+        bitarray, so at most the .bed genotypes and the kept SNPs are in memory at once.
+
         '''
         nru = self.nru
-        m_poly = 0
-        y = ba.bitarray()
+        G = np.frombuffer(geno, dtype='uint8').reshape((m, nru // 4))
         if keep_snps is None:
-            keep_snps = xrange(m)
-        kept_snps = []
-        freq = []
-        for e, j in enumerate(keep_snps):
-            z = geno[2*nru*j:2*nru*(j+1)]
-            A = z[0::2]
-            a = A.count()
-            B = z[1::2]
-            b = B.count()
-            c = (A & B).count()
-            major_ct = b + c  # number of copies of the major allele
-            n_nomiss = n - a + c  # number of individuals with nonmissing genotypes
-            f = major_ct / (2*n_nomiss) if n_nomiss > 0 else 0
-            het_miss_ct = a+b-2*c  # remove SNPs that are only either het or missing
-            if np.minimum(f, 1-f) > mafMin and het_miss_ct < n:
-                freq.append(f)
-                y += z
-                m_poly += 1
-                kept_snps.append(j)
-
-        return (y, m_poly, n, kept_snps, freq)
+            keep_snps = np.arange(m)
+
+        keep_snps = np.array(keep_snps, dtype='int')
+        bits = np.unpackbits(np.arange(256, dtype='uint8')[:, np.newaxis], axis=1)[:, ::-1]
+        count_A = np.sum(bits[:, 0::2], axis=1).astype('uint8')  # popcount(byte & 0x55)
+        count_B = np.sum(bits[:, 1::2], axis=1).astype('uint8')  # popcount(byte & 0xAA)
+        count_C = np.sum(bits[:, 0::2] & bits[:, 1::2], axis=1).astype('uint8')
+        pad_mask = (1 << 2*(n % 4)) - 1 if n % 4 != 0 else 255
+        chunk_size = max(1, 2**25 // nru)
+        a, b, c = [np.zeros(len(keep_snps), dtype='int64') for i in xrange(3)]
+        for i in xrange(0, len(keep_snps), chunk_size):
+            Z = G[keep_snps[i:i+chunk_size], 0:(n + 3) // 4]
+            Z[:, -1] &= pad_mask
+            a[i:i+chunk_size] = np.sum(count_A[Z], axis=1)
+            b[i:i+chunk_size] = np.sum(count_B[Z], axis=1)
+            c[i:i+chunk_size] = np.sum(count_C[Z], axis=1)
+
+        major_ct = b + c  # number of copies of the major allele
+        n_nomiss = n - a + c  # number of individuals with nonmissing genotypes
+        f = np.zeros(len(keep_snps))
+        ii = n_nomiss > 0
+        f[ii] = major_ct[ii] / (2*n_nomiss[ii])
+        het_miss_ct = a+b-2*c  # remove SNPs that are only either het or missing
+        ii = (np.minimum(f, 1-f) > mafMin) & (het_miss_ct < n)
+        kept_snps = keep_snps[ii]
+        y, Y = _packed_rows(len(kept_snps), nru // 4)
+        for i in xrange(0, len(kept_snps), chunk_size):
+            Y[i:i+chunk_size, :] = G[kept_snps[i:i+chunk_size], :]
+
+        del G, Y  # views of the buffers of geno and y
+        return (y, len(kept_snps), n, list(kept_snps), list(f[ii]))
+
+    def nextSNPsPacked(self, b):
+        '''
+        Returns the packed .bed genotypes of the next b SNPs, without decoding them, as an
+        (nru / 32 rounded up) x b matrix of little-endian uint64 words. Each word holds the
+        2-bit codes of 32 individuals; the pad bits at the end of each SNP are zero.
+        '''
+        b = self.__check_next__(b)
+        X = self.__packed__(self._currentSNP, b)
+        n_bytes = 8*((X.shape[1] + 7) // 8)
+        Y = np.zeros((b, n_bytes), dtype='uint8')
+        Y[:, 0:X.shape[1]] = X
+        self._currentSNP += b
+        return np.ascontiguousarray(Y.view(_PACKED_DTYPE).T)
 
-    def nextSNPs(self, b, minorRef=None):
+    def __packed__(self, c, b):
+        '''Returns the packed genotypes of the b SNPs starting at SNP c as a b x nru/4 matrix.'''
+        nru = self.nru
+        G = np.frombuffer(self.geno, dtype='uint8')  # a view of the buffer of the bitarray
+        return G[c*nru // 4:(c+b)*nru // 4].reshape((b, nru // 4))
+
+    def __decode__(self, c, b):
         '''
-        Unpacks the binary array of genotypes and returns an n x b matrix of floats of
-        normalized genotypes for the next b SNPs, where n := number of samples.
+        Returns a b x n float64 matrix of the genotypes (0, 1, 2, or 9 for missing) of the
+        b SNPs starting at SNP c.
+        '''
+        nru = self.nru
+        slice = self.geno[2*c*nru:2*(c+b)*nru]
+        X = self._bedcode[np.frombuffer(slice.tobytes(), dtype='uint8')]
+        return X.reshape((b, nru))[:, 0:self.n]
 
-        Parameters
-        ----------
-        b : int
-            Number of SNPs to return.
-        minorRef: bool, default None
-            Should we flip reference alleles so that the minor allele is the reference?
-            (This is useful for computing l1 w.r.t. minor allele).
 
-        Returns
-        -------
-        X : np.array with dtype float64 with shape (n, b), where n := number of samples
-            Matrix of genotypes normalized to mean zero and variance one. If minorRef is
-            not None, then the minor allele will be the positive allele (i.e., two copies
-            of the minor allele --> a positive number).
+class PlinkBEDFileMemmap(PlinkBEDFile):
+    '''
+    Interface for Plink .bed format that memory-maps the .bed file instead of reading it
+    into memory. SNP and individual filters only record the indices to keep; the bytes
+    of the kept SNPs are read from the mapped file as nextSNPs asks for them.
+    '''
+    def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
+        self._keep_indivs = None
+        PlinkBEDFile.__init__(self, fname, n, snp_list, keep_snps=keep_snps,
+            keep_indivs=keep_indivs, mafMin=mafMin)
+
+    def __read__(self, fname, m, n):
+        if not fname.endswith('.bed'):
+            raise ValueError('.bed filename must end in .bed')
+
+        fh = open(fname, 'rb')
+        magicNumber = ba.bitarray(endian="little")
+        magicNumber.fromfile(fh, 2)
+        bedMode = ba.bitarray(endian="little")
+        bedMode.fromfile(fh, 1)
+        fh.close()
+        e = (4 - n % 4) if n % 4 != 0 else 0
+        nru = n + e
+        self.nru = nru
+        # check magic number
+        if magicNumber != ba.bitarray('0011011011011000'):
+            raise IOError("Magic number from Plink .bed file not recognized")
+
+        if bedMode != ba.bitarray('10000000'):
+            raise IOError("Plink .bed file must be in default SNP-major mode")
 
+        # check file length
+        real_len = 8*(os.path.getsize(fname) - 3)
+        if real_len != 2*m*nru:
+            s = "Plink .bed file has {n1} bits, expected {n2}"
+            raise IOError(s.format(n1=real_len, n2=2*m*nru))
+
+        self.geno = np.memmap(fname, dtype='uint8', mode='r', offset=3, shape=(m, nru // 4))
+        return (self.nru, self.geno)
+
+    def __filter_indivs__(self, geno, keep_indivs, m, n):
+        # defer to __decode__, so that no filtered copy of the genotypes is ever built
+        self._keep_indivs = keep_indivs
+        return (geno, m, len(keep_indivs))
+
+    def __filter_snps_maf__(self, geno, m, n, mafMin, keep_snps):
         '''
+        Same filters as PlinkBEDFile.__filter_snps_maf__, computed from the genotypes of
+        a few MB worth of SNPs at a time. Returns the memory map unchanged, together with
+        the indices of the SNPs that pass.
 
-        try:
-            b = int(b)
-            if b <= 0:
-                raise ValueError("b must be > 0")
-        except TypeError:
-            raise TypeError("b must be an integer")
+        '''
+        if keep_snps is None:
+            keep_snps = np.arange(m)
 
-        if self._currentSNP + b > self.m:
-            s = '{b} SNPs requested, {k} SNPs remain'
-            raise ValueError(s.format(b=b, k=(self.m-self._currentSNP)))
+        keep_snps = np.array(keep_snps, dtype='int')
+        bedcode = self._bedcode.astype('uint8')
+        chunk_size = max(1, 2**25 // self.nru)
+        kept_snps = []
+        freq = []
+        for i in xrange(0, len(keep_snps), chunk_size):
+            j = keep_snps[i:i+chunk_size]
+            X = self.__decode_rows__(j, bedcode)
+            miss = X == 9
+            X[miss] = 0
+            major_ct = np.sum(X, axis=1)  # number of copies of the major allele
+            n_nomiss = n - np.sum(miss, axis=1)  # number of individuals w/ nonmissing genotypes
+            f = np.zeros(len(j))
+            ii = n_nomiss > 0
+            f[ii] = major_ct[ii] / (2*n_nomiss[ii])
+            het_miss_ct = np.sum(X == 1, axis=1) + n - n_nomiss
+            ii = (np.minimum(f, 1-f) > mafMin) & (het_miss_ct < n)
+            freq.extend(f[ii])
+            kept_snps.extend(j[ii])
+
+        return (geno, len(kept_snps), n, kept_snps, freq)
+
+    def __decode__(self, c, b):
+        return self.__decode_rows__(np.array(self.kept_snps[c:c+b], dtype='int'), self._bedcode)
+
+    def __packed__(self, c, b):
+        G = self.geno[np.array(self.kept_snps[c:c+b], dtype='int'), :]
+        if self._keep_indivs is not None:
+            e = (4 - self.n % 4) if self.n % 4 != 0 else 0
+            return _subset_packed(G, self._keep_indivs, self.n + e)
+        else:
+            return G
 
-        c = self._currentSNP
-        n = self.n
-        nru = self.nru
-        slice = self.geno[2*c*nru:2*(c+b)*nru]
-        X = np.array(slice.decode(self._bedcode), dtype="float64").reshape((b, nru)).T
-        X = X[0:n, :]
-        Y = np.zeros(X.shape)
-        for j in xrange(0, b):
-            newsnp = X[:, j]
-            ii = newsnp != 9
-            avg = np.mean(newsnp[ii])
-            newsnp[np.logical_not(ii)] = avg
-            denom = np.std(newsnp)
-            if denom == 0:
-                denom = 1
-
-            if minorRef is not None and self.freq[self._currentSNP + j] > 0.5:
-                denom = denom*-1
-
-            Y[:, j] = (newsnp - avg) / denom
+    def __decode_rows__(self, rows, bedcode):
+        '''Decodes the SNPs with indices rows (in the .bed file) into a len(rows) x n matrix.'''
+        X = bedcode[self.geno[rows, :]].reshape((len(rows), self.nru))
+        if self._keep_indivs is not None:
+            return np.ascontiguousarray(X[:, self._keep_indivs])
+        else:
+            return X[:, 0:self.n]
 
-        self._currentSNP += b
-        return Y
+
+_DOSAGE_MAGIC = 'LDSCDOS1'
+_DOSAGE_MISSING = 65535
+_DOSAGE_SCALE = 32767  # a dosage d is stored as round(d * _DOSAGE_SCALE)
+
+
+def write_dosage(fname, dosages):
+    '''
+    Writes an M x N matrix of allele dosages in [0, 2] (NaN for missing) in the format read
+    by DosageFile: the 8 byte magic number LDSCDOS1, M and N as little-endian uint32, then
+    one row of N little-endian uint16 per SNP, with dosage d stored as round(d * 32767) and
+    65535 for missing.
+    '''
+    dosages = np.asarray(dosages, dtype='float64')
+    m, n = dosages.shape
+    if np.any(dosages[~np.isnan(dosages)] < 0) or np.any(dosages[~np.isnan(dosages)] > 2):
+        raise ValueError('Dosages must be between 0 and 2.')
+
+    with open(fname, 'wb') as f:
+        f.write(_DOSAGE_MAGIC)
+        f.write(np.array([m, n], dtype='<u4').tostring())
+        chunk_size = max(1, 2**25 // (2*n))
+        for i in xrange(0, m, chunk_size):
+            x = dosages[i:i+chunk_size]
+            y = np.where(np.isnan(x), _DOSAGE_MISSING, np.round(x*_DOSAGE_SCALE))
+            f.write(y.astype('<u2').tostring())
+
+
+class DosageFile(__GenotypeArrayInMemory__):
+    '''
+    Interface for allele dosages (e.g., from imputed reference panels) in the format written
+    by write_dosage. The dosage file is memory-mapped; the dosages of a few MB worth of SNPs
+    at a time are decoded for the MAF filter, and nextSNPs decodes only the SNPs it returns.
+    SNPs pass the MAF filter if the MAF computed from the mean dosage is > mafMin and
+    the dosages are not constant.
+    '''
+    def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
+        self._keep_indivs = None
+        __GenotypeArrayInMemory__.__init__(self, fname, n, snp_list, keep_snps=keep_snps,
+            keep_indivs=keep_indivs, mafMin=mafMin)
+
+    def __read__(self, fname, m, n):
+        if not fname.endswith('.dos'):
+            raise ValueError('Dosage filename must end in .dos')
+
+        with open(fname, 'rb') as fh:
+            magic = fh.read(len(_DOSAGE_MAGIC))
+            if magic != _DOSAGE_MAGIC:
+                raise IOError('Magic number from dosage file not recognized')
+
+            m_file, n_file = np.fromstring(fh.read(8), dtype='<u4')
+
+        if m_file != m or n_file != n:
+            s = 'Dosage file has {m1} SNPs and {n1} individuals, expected {m2} and {n2}'
+            raise IOError(s.format(m1=m_file, n1=n_file, m2=m, n2=n))
+
+        offset = len(_DOSAGE_MAGIC) + 8
+        real_len = os.path.getsize(fname) - offset
+        if real_len != 2*m*n:
+            s = 'Dosage file has {n1} bytes of dosages, expected {n2}'
+            raise IOError(s.format(n1=real_len, n2=2*m*n))
+
+        self.nru = n
+        self.geno = np.memmap(fname, dtype='<u2', mode='r', offset=offset, shape=(m, n))
+        return (self.nru, self.geno)
+
+    def __filter_indivs__(self, geno, keep_indivs, m, n):
+        # defer to __decode__, so that no filtered copy of the dosages is ever built
+        self._keep_indivs = keep_indivs
+        return (geno, m, len(keep_indivs))
+
+    def __filter_snps_maf__(self, geno, m, n, mafMin, keep_snps):
+        if keep_snps is None:
+            keep_snps = np.arange(m)
+
+        keep_snps = np.array(keep_snps, dtype='int')
+        chunk_size = max(1, 2**25 // (2*self.nru))
+        kept_snps = []
+        freq = []
+        for i in xrange(0, len(keep_snps), chunk_size):
+            j = keep_snps[i:i+chunk_size]
+            X = self.__decode_rows__(j)
+            miss = X == 9
+            X[miss] = 0
+            n_nomiss = n - np.sum(miss, axis=1)
+            f = np.zeros(len(j))
+            ii = n_nomiss > 0
+            f[ii] = np.sum(X, axis=1)[ii] / (2*n_nomiss[ii])
+            x_max = np.max(np.where(miss, -np.inf, X), axis=1)
+            x_min = np.min(np.where(miss, np.inf, X), axis=1)
+            const = x_max <= x_min  # only one distinct nonmissing dosage (or none)
+            ii = (np.minimum(f, 1-f) > mafMin) & np.logical_not(const)
+            freq.extend(f[ii])
+            kept_snps.extend(j[ii])
+
+        return (geno, len(kept_snps), n, kept_snps, freq)
+
+    def __decode__(self, c, b):
+        return self.__decode_rows__(np.array(self.kept_snps[c:c+b], dtype='int'))
+
+    def __decode_rows__(self, rows):
+        '''Decodes the SNPs with indices rows (in the dosage file) into a len(rows) x n matrix.'''
+        G = self.geno[rows, :]
+        if self._keep_indivs is not None:
+            G = G[:, self._keep_indivs]
+
+        X = G / _DOSAGE_SCALE
+        X[G == _DOSAGE_MISSING] = 9
+        return X
@@ -9,6 +9,15 @@ from __future__ import division
 import numpy as np
 import pandas as pd
 import os
+import json
+import struct
+import multiprocessing
+import gzip
+import bz2
+
+_LDSCORE_BIN_MAGIC = 'LDSCBIN1'
+# dtypes of the non-LD Score columns of .l2.ldscore files; CHR and BP are only used for sorting
+_L2_DTYPES = {'CHR': np.int16, 'BP': np.int32, 'SNP': str, 'CM': np.float64, 'MAF': np.float64}
 
 
 def series_eq(x, y):
@@ -20,6 +29,28 @@ def read_csv(fh, **kwargs):
     return pd.read_csv(fh, delim_whitespace=True, na_values='.', **kwargs)
 
 
+def _apply(args):
+    '''Calls args[0](*args[1:]). For use with Pool.map.'''
+    return args[0](*args[1:])
+
+
+def parallel_map(func, args_list, threads=1):
+    '''
+    Returns [func(*args) for args in args_list], in the same order. If threads > 1, the calls
+    are split across a pool of that many processes (func must be a module-level function).
+
+    '''
+    if threads > 1 and len(args_list) > 1:
+        pool = multiprocessing.Pool(min(threads, len(args_list)))
+        try:
+            return pool.map(_apply, [(func,) + tuple(args) for args in args_list], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [func(*args) for args in args_list]
+
+
 def sub_chr(s, chr):
     '''Substitute chr for @, else append chr to the end of str.'''
     if '@' not in s:
@@ -86,11 +117,11 @@ def sumstats(fh, alleles=False, dropna=True):
     return x
 
 
-def ldscore_fromlist(flist, num=None):
+def ldscore_fromlist(flist, num=None, threads=1):
     '''Sideways concatenation of a list of LD Score files.'''
     ldscore_array = []
     for i, fh in enumerate(flist):
-        y = ldscore(fh, num)
+        y = ldscore(fh, num, threads)
         if i > 0:
             if not series_eq(y.SNP, ldscore_array[0].SNP):
                 raise ValueError('LD Scores for concatenation must have identical SNP columns.')
@@ -104,9 +135,157 @@ def ldscore_fromlist(flist, num=None):
     return pd.concat(ldscore_array, axis=1)
 
 
+def ldscore_compression(fh):
+    '''
+    Like which_compression, but also finds LD Score files in the binary .bin format. If there
+    is both a .bin file and a text file, it is not clear which one is current (e.g., one may
+    be left over from an earlier run with or without --binary-ldscore), so this raises a
+    ValueError.
+
+    '''
+    if not os.access(fh + '.bin', 4):
+        return which_compression(fh)
+
+    text = [fh + s for s in ('.bz2', '.gz', '') if os.access(fh + s, 4)]
+    if len(text) > 0:
+        raise ValueError('Found both {B} and {T}. Remove the one that is out of date.'.format(
+            B=fh + '.bin', T=text[0]))
+
+    return '.bin', 'bin'
+
+
+def write_ldscore_bin(fh, df, M, M_5_50):
+    '''
+    Writes the LD Scores in df (columns CHR, SNP, BP, [LD Scores]) to fh in the binary
+    columnar .l2.ldscore.bin format.
+
+    The file starts with an 8-byte magic string, followed by the columns (CHR and BP as
+    int32, SNP as fixed-width strings and the LD Scores as float32), each padded to a
+    multiple of 8 bytes, a JSON footer with the column layout, the row groups of each
+    chromosome and M / M_5_50, and finally the length of the footer and the magic string.
+
+    '''
+    n = len(df)
+    columns, row_groups = [], []
+    chrs = df.CHR.values
+    breaks = np.r_[0, np.nonzero(chrs[1:] != chrs[:-1])[0] + 1, n]
+    for start, stop in zip(breaks[:-1], breaks[1:]):
+        if stop > start:
+            row_groups.append([str(chrs[start]), int(start), int(stop)])
+
+    with open(fh, 'wb') as f:
+        f.write(_LDSCORE_BIN_MAGIC)
+        for c in df.columns:
+            x = _ldscore_bin_column(c, df[c].values)
+            columns.append([str(c), x.dtype.str, f.tell()])
+            f.write(x.tostring())
+            f.write('\0' * (-f.tell() % 8))
+
+        footer = json.dumps({'n': n, 'columns': columns, 'row_groups': row_groups,
+                             'M': [float(y) for y in M],
+                             'M_5_50': [float(y) for y in M_5_50]})
+        f.write(footer)
+        f.write(struct.pack('<Q', len(footer)))
+        f.write(_LDSCORE_BIN_MAGIC)
+
+
+def _ldscore_bin_column(c, x):
+    '''Converts column c of an LD Score file to the dtype it is stored with in the .bin format.'''
+    if c in ('CHR', 'BP'):
+        try:
+            x = np.asarray(x, dtype='<i8')
+        except ValueError:  # e.g., CHR = X
+            return np.asarray(x, dtype=str)
+
+        if len(x) == 0 or (x.min() >= np.iinfo('<i4').min and x.max() <= np.iinfo('<i4').max):
+            x = x.astype('<i4')
+        return x
+    elif c == 'SNP':
+        return np.asarray(x, dtype=str)
+    else:
+        return np.asarray(x, dtype='<f4')
+
+
+def ldscore_bin_footer(fh):
+    '''Reads the JSON footer of a .l2.ldscore.bin file.'''
+    with open(fh, 'rb') as f:
+        magic = f.read(8)
+        f.seek(-16, 2)
+        footer_len, = struct.unpack('<Q', f.read(8))
+        if magic != _LDSCORE_BIN_MAGIC or f.read(8) != _LDSCORE_BIN_MAGIC:
+            raise ValueError('{F} is not a .l2.ldscore.bin file.'.format(F=fh))
+
+        f.seek(-16 - footer_len, 2)
+        return json.loads(f.read(footer_len))
+
+
+def read_ldscore_bin(fh, chr=None):
+    '''
+    Reads a .l2.ldscore.bin file written by write_ldscore_bin. The columns are memory-mapped,
+    so no text is parsed and only the rows that are used are read from disk. If chr is not
+    None, only the row group of chromosome chr is read. Each column is copied once, into the
+    DataFrame (the LD Scores as float64).
+
+    '''
+    footer = ldscore_bin_footer(fh)
+    start, stop = 0, footer['n']
+    if chr is not None:
+        groups = [g for g in footer['row_groups'] if g[0] == str(chr)]
+        if len(groups) == 0:
+            raise ValueError('No SNPs on chromosome {C} in {F}.'.format(C=chr, F=fh))
+        start, stop = groups[0][1], groups[0][2]
+
+    x = pd.DataFrame()
+    for c, dtype, offset in footer['columns']:
+        dtype = np.dtype(str(dtype))
+        if stop > start:
+            y = np.memmap(fh, dtype=dtype, mode='r', offset=offset + start*dtype.itemsize,
+                          shape=(stop - start,))
+        else:
+            y = np.zeros(0, dtype=dtype)
+        if dtype.kind == 'S':
+            y = y.astype(object)
+        elif dtype.kind == 'f':
+            y = y.astype(float)
+        x[str(c)] = y
+
+    return x
+
+
+def read_header(fh, compression):
+    '''Returns the whitespace-delimited column names in the first line of fh.'''
+    if compression == 'gzip':
+        f = gzip.open(fh)
+    elif compression == 'bz2':
+        f = bz2.BZ2File(fh)
+    else:
+        f = open(fh)
+
+    try:
+        return f.readline().split()
+    finally:
+        f.close()
+
+
 def l2_parser(fh, compression):
     '''Parse LD Score files'''
-    x = read_csv(fh, header=0, compression=compression)
+    if compression == 'bin':
+        x = read_ldscore_bin(fh)
+    else:
+        # fast path: skip MAF and CM, parse the LD Scores directly as float64 without type
+        # inference, and don't look for missing values. Files with missing values or
+        # non-numeric CHR or BP raise a ValueError and are parsed the slow way.
+        header = read_header(fh, compression)
+        usecols = header
+        if 'MAF' in header and 'CM' in header:  # for backwards compatibility w/ v<1.0.0
+            usecols = [c for c in header if c not in ('MAF', 'CM')]
+        dtype = {c: _L2_DTYPES.get(c, np.float64) for c in usecols}
+        try:
+            x = read_csv(fh, header=0, compression=compression, usecols=usecols, dtype=dtype,
+                         na_filter=False)
+        except ValueError:
+            x = read_csv(fh, header=0, compression=compression)
+
     if 'MAF' in x.columns and 'CM' in x.columns:  # for backwards compatibility w/ v<1.0.0
         x = x.drop(['MAF', 'CM'], axis=1)
     return x
@@ -129,30 +308,48 @@ def frq_parser(fh, compression):
     return df[['SNP', 'FRQ']]
 
 
-def ldscore(fh, num=None):
-    '''Parse .l2.ldscore files, split across num chromosomes. See docs/file_formats_ld.txt.'''
+def ldscore(fh, num=None, threads=1):
+    '''
+    Parse .l2.ldscore files, split across num chromosomes. See docs/file_formats_ld.txt.
+    If threads > 1, the files of different chromosomes are parsed in parallel.
+
+    '''
     suffix = '.l2.ldscore'
     if num is not None:  # num files, e.g., one per chromosome
         first_fh = sub_chr(fh, 1) + suffix
-        s, compression = which_compression(first_fh)
-        chr_ld = [l2_parser(sub_chr(fh, i) + suffix + s, compression) for i in xrange(1, num + 1)]
+        s, compression = ldscore_compression(first_fh)
+        chr_ld = parallel_map(l2_parser, [(sub_chr(fh, i) + suffix + s, compression)
+                                          for i in xrange(1, num + 1)], threads)
         x = pd.concat(chr_ld)  # automatically sorted by chromosome
     else:  # just one file
-        s, compression = which_compression(fh + suffix)
+        s, compression = ldscore_compression(fh + suffix)
         x = l2_parser(fh + suffix + s, compression)
 
-    x = x.sort_values(by=['CHR', 'BP']) # SEs will be wrong unless sorted
+    chrs, bp = x.CHR.values, x.BP.values
+    is_sorted = np.all((chrs[1:] > chrs[:-1]) | ((chrs[1:] == chrs[:-1]) & (bp[1:] >= bp[:-1])))
+    if not is_sorted:  # files written by ldsc.py --l2 are already sorted
+        x = x.sort_values(by=['CHR', 'BP']) # SEs will be wrong unless sorted
     x = x.drop(['CHR', 'BP'], axis=1).drop_duplicates(subset='SNP')
     return x
 
 
 def M(fh, num=None, N=2, common=False):
-    '''Parses .l{N}.M files, split across num chromosomes. See docs/file_formats_ld.txt.'''
-    parsefunc = lambda y: [float(z) for z in open(y, 'r').readline().split()]
+    '''
+    Parses .l{N}.M files, split across num chromosomes. See docs/file_formats_ld.txt.
+    If there is no .l{N}.M file, M is read from the footer of the .l{N}.ldscore.bin file.
+
+    '''
     suffix = '.l' + str(N) + '.M'
     if common:
         suffix += '_5_50'
 
+    def parsefunc(y):
+        bin_fh = y[:-len(suffix)] + '.l' + str(N) + '.ldscore.bin'
+        if not os.access(y, 4) and os.access(bin_fh, 4):
+            return ldscore_bin_footer(bin_fh)['M_5_50' if common else 'M']
+
+        return [float(z) for z in open(y, 'r').readline().split()]
+
     if num is not None:
         x = np.sum([parsefunc(sub_chr(fh, i) + suffix) for i in xrange(1, num + 1)], axis=0)
     else:
@@ -166,11 +363,20 @@ def M_fromlist(flist, num=None, N=2, common=False):
     return np.hstack([M(fh, num, N, common) for fh in flist])
 
 
-def annot(fh_list, num=None, frqfile=None):
+def _annot_overlap(parser_args):
+    '''Returns the overlap matrix and the number of SNPs of the .annot files in parser_args.'''
+    df_annot_chr_list = [annot_parser(*args) for args in parser_args]
+    annot_matrix_chr_list = [np.matrix(df_annot_chr) for df_annot_chr in df_annot_chr_list]
+    annot_matrix_chr = np.hstack(annot_matrix_chr_list)
+    return np.dot(annot_matrix_chr.T, annot_matrix_chr), len(df_annot_chr_list[0])
+
+
+def annot(fh_list, num=None, frqfile=None, threads=1):
     '''
     Parses .annot files and returns an overlap matrix. See docs/file_formats_ld.txt.
     If num is not None, parses .annot files split across [num] chromosomes (e.g., the
-    output of parallelizing ldsc.py --l2 across chromosomes).
+    output of parallelizing ldsc.py --l2 across chromosomes). If threads > 1, the files of
+    different chromosomes are parsed in parallel.
 
     '''
     annot_suffix = ['.annot' for fh in fh_list]
@@ -188,23 +394,20 @@ def annot(fh_list, num=None, frqfile=None):
             frq_s, frq_compression = which_compression(first_frqfile)
             frq_suffix += frq_s
 
-        y = []
-        M_tot = 0
+        chr_args = []
         for chr in xrange(1, num + 1):
             if frqfile is not None:
-                df_annot_chr_list = [annot_parser(sub_chr(fh, chr) + annot_suffix[i], annot_compression[i],
-                                                  sub_chr(frqfile, chr) + frq_suffix, frq_compression)
-                                     for i, fh in enumerate(fh_list)]
+                chr_args.append([(sub_chr(fh, chr) + annot_suffix[i], annot_compression[i],
+                                  sub_chr(frqfile, chr) + frq_suffix, frq_compression)
+                                 for i, fh in enumerate(fh_list)])
             else:
-                df_annot_chr_list = [annot_parser(sub_chr(fh, chr) + annot_suffix[i], annot_compression[i])
-                                     for i, fh in enumerate(fh_list)]
-
-            annot_matrix_chr_list = [np.matrix(df_annot_chr) for df_annot_chr in df_annot_chr_list]
-            annot_matrix_chr = np.hstack(annot_matrix_chr_list)
-            y.append(np.dot(annot_matrix_chr.T, annot_matrix_chr))
-            M_tot += len(df_annot_chr_list[0])
+                chr_args.append([(sub_chr(fh, chr) + annot_suffix[i], annot_compression[i])
+                                 for i, fh in enumerate(fh_list)])
 
-        x = sum(y)
+        # only the overlap matrix of each chromosome is returned from the workers
+        y = parallel_map(_annot_overlap, [(args,) for args in chr_args], threads)
+        x = sum(z[0] for z in y)
+        M_tot = sum(z[1] for z in y)
     else:  # just one file
         for i, fh in enumerate(fh_list):
             annot_s, annot_comp_single = which_compression(fh + annot_suffix[i])
@@ -139,7 +139,8 @@ def h2_obs_to_liab(h2_obs, P, K):
 
 class LD_Score_Regression(object):
 
-    def __init__(self, y, x, w, N, M, n_blocks, intercept=None, slow=False, step1_ii=None, old_weights=False):
+    def __init__(self, y, x, w, N, M, n_blocks, intercept=None, slow=False, step1_ii=None, old_weights=False,
+                 max_iter=2, tol=None):
         for i in [y, x, w, M, N]:
             try:
                 if len(i.shape) != 2:
@@ -172,6 +173,7 @@ class LD_Score_Regression(object):
             self.intercept_se = 'NA'
         del y
         self.twostep_filtered = None
+        self.irwls_fits = []
         if step1_ii is not None and self.constrain_intercept:
             raise ValueError(
                 'twostep is not compatible with constrain_intercept.')
@@ -187,7 +189,8 @@ class LD_Score_Regression(object):
             update_func1 = lambda a: self._update_func(
                 a, x1, w1, N1, M_tot, Nbar, ii=step1_ii)
             step1_jknife = IRWLS(
-                x1, yp1, update_func1, n_blocks, slow=slow, w=initial_w1)
+                x1, yp1, update_func1, n_blocks, slow=slow, w=initial_w1, max_iter=max_iter,
+                tol=tol)
             step1_int, _ = self._intercept(step1_jknife)
             yp = yp - step1_int
             x = remove_intercept(x)
@@ -196,7 +199,9 @@ class LD_Score_Regression(object):
                 a, x_tot, w, N, M_tot, Nbar, step1_int)
             s = update_separators(step1_jknife.separators, step1_ii)
             step2_jknife = IRWLS(
-                x, yp, update_func2, n_blocks, slow=slow, w=initial_w, separators=s)
+                x, yp, update_func2, n_blocks, slow=slow, w=initial_w, separators=s,
+                max_iter=max_iter, tol=tol)
+            self.irwls_fits = [step1_jknife, step2_jknife]
             c = np.sum(np.multiply(initial_w, x)) / \
                 np.sum(np.multiply(initial_w, np.square(x)))
             jknife = self._combine_twostep_jknives(
@@ -210,7 +215,9 @@ class LD_Score_Regression(object):
             update_func = lambda a: self._update_func(
                 a, x_tot, w, N, M_tot, Nbar, intercept)
             jknife = IRWLS(
-                x, yp, update_func, n_blocks, slow=slow, w=initial_w)
+                x, yp, update_func, n_blocks, slow=slow, w=initial_w, max_iter=max_iter,
+                tol=tol)
+            self.irwls_fits = [jknife]
 
         self.coef, self.coef_cov, self.coef_se = self._coef(jknife, Nbar)
         self.cat, self.cat_cov, self.cat_se =\
@@ -234,6 +241,18 @@ class LD_Score_Regression(object):
 
         self.M = M
 
+    def irwls_summary(self):
+        '''Report the number of IRWLS steps and the weight change at each step.'''
+        out = []
+        for i, fit in enumerate(self.irwls_fits):
+            name = 'IRWLS'
+            if len(self.irwls_fits) > 1:
+                name += ' (two-step, step {I})'.format(I=i + 1)
+            deltas = ' '.join('{:.4g}'.format(d) for d in fit.w_deltas)
+            out.append('{S}: {N} iterations, max relative weight change per iteration: {D}'.format(
+                S=name, N=fit.n_iter, D=deltas))
+        return '\n'.join(out)
+
     @classmethod
     def aggregate(cls, y, x, N, M, intercept=None):
         if intercept is None:
@@ -288,9 +307,8 @@ class LD_Score_Regression(object):
         n_blocks = jknife.delete_values.shape[0]
         numer_delete_vals = np.multiply(
             M, jknife.delete_values[:, 0:n_annot]) / Nbar  # (n_blocks, n_annot)
-        denom_delete_vals = np.sum(
-            numer_delete_vals, axis=1).reshape((n_blocks, 1))
-        denom_delete_vals = np.dot(denom_delete_vals, np.ones((1, n_annot)))
+        denom_delete_vals = np.repeat(
+            np.sum(numer_delete_vals, axis=1).reshape((n_blocks, 1)), n_annot, axis=1)
         prop = jk.RatioJackknife(
             cat / tot, numer_delete_vals, denom_delete_vals)
         return prop.est, prop.jknife_cov, prop.jknife_se
@@ -337,13 +355,15 @@ class Hsq(LD_Score_Regression):
 
     __null_intercept__ = 1
 
-    def __init__(self, y, x, w, N, M, n_blocks=200, intercept=None, slow=False, twostep=None, old_weights=False):
+    def __init__(self, y, x, w, N, M, n_blocks=200, intercept=None, slow=False, twostep=None, old_weights=False,
+                 max_iter=2, tol=None):
         step1_ii = None
         if twostep is not None:
             step1_ii = y < twostep
 
         LD_Score_Regression.__init__(self, y, x, w, N, M, n_blocks, intercept=intercept,
-                                     slow=slow, step1_ii=step1_ii, old_weights=old_weights)
+                                     slow=slow, step1_ii=step1_ii, old_weights=old_weights,
+                                     max_iter=max_iter, tol=tol)
         self.mean_chisq, self.lambda_gc = self._summarize_chisq(y)
         if not self.constrain_intercept:
             self.ratio, self.ratio_se = self._ratio(
@@ -539,7 +559,8 @@ class Gencov(LD_Score_Regression):
     __null_intercept__ = 0
 
     def __init__(self, z1, z2, x, w, N1, N2, M, hsq1, hsq2, intercept_hsq1, intercept_hsq2,
-                 n_blocks=200, intercept_gencov=None, slow=False, twostep=None):
+                 n_blocks=200, intercept_gencov=None, slow=False, twostep=None, max_iter=2,
+                 tol=None):
         self.intercept_hsq1 = intercept_hsq1
         self.intercept_hsq2 = intercept_hsq2
         self.hsq1 = hsq1
@@ -552,7 +573,8 @@ class Gencov(LD_Score_Regression):
             step1_ii = np.logical_and(z1**2 < twostep, z2**2 < twostep)
 
         LD_Score_Regression.__init__(self, y, x, w, np.sqrt(N1 * N2), M, n_blocks,
-                                     intercept=intercept_gencov, slow=slow, step1_ii=step1_ii)
+                                     intercept=intercept_gencov, slow=slow, step1_ii=step1_ii,
+                                     max_iter=max_iter, tol=tol)
         self.p, self.z = p_z_norm(self.tot, self.tot_se)
         self.mean_z1z2 = np.mean(np.multiply(z1, z2))
 
@@ -680,17 +702,18 @@ class Gencov(LD_Score_Regression):
 class RG(object):
 
     def __init__(self, z1, z2, x, w, N1, N2, M, intercept_hsq1=None, intercept_hsq2=None,
-                 intercept_gencov=None, n_blocks=200, slow=False, twostep=None):
+                 intercept_gencov=None, n_blocks=200, slow=False, twostep=None, max_iter=2,
+                 tol=None):
         self.intercept_gencov = intercept_gencov
         self._negative_hsq = None
         n_snp, n_annot = x.shape
         hsq1 = Hsq(np.square(z1), x, w, N1, M, n_blocks=n_blocks, intercept=intercept_hsq1,
-                   slow=slow, twostep=twostep)
+                   slow=slow, twostep=twostep, max_iter=max_iter, tol=tol)
         hsq2 = Hsq(np.square(z2), x, w, N2, M, n_blocks=n_blocks, intercept=intercept_hsq2,
-                   slow=slow, twostep=twostep)
+                   slow=slow, twostep=twostep, max_iter=max_iter, tol=tol)
         gencov = Gencov(z1, z2, x, w, N1, N2, M, hsq1.tot, hsq2.tot, hsq1.intercept,
                         hsq2.intercept, n_blocks, intercept_gencov=intercept_gencov, slow=slow,
-                        twostep=twostep)
+                        twostep=twostep, max_iter=max_iter, tol=tol)
         gencov.N1 = None  # save memory
         gencov.N2 = None
         self.hsq1, self.hsq2, self.gencov = hsq1, hsq2, gencov
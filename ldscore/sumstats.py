@@ -20,6 +20,7 @@ import os
 
 
 _N_CHR = 22
+_SNP_CODE = 'SNP_CODE'  # name of the index of data frames indexed by integer SNP codes
 # complementary bases
 COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
 # bases
@@ -65,12 +66,72 @@ def _select_and_log(x, ii, log, msg):
     return x
 
 
+class SNPIndex(object):
+    '''
+    Maps rs numbers to integer SNP codes, so that smart_merge can join data frames on the
+    codes instead of the rs numbers. The codes are the positions of the SNPs in the
+    reference panel LD Scores, so the hash table of rs numbers is built once and each
+    data frame is hashed against it only once.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Data frame with a SNP column. If df is indexed by SNP codes (see code), the codes
+        are taken from the index; otherwise, the code of a SNP is its row number.
+
+    '''
+    def __init__(self, df):
+        self.snps = pd.Index(df.SNP)
+        if df.index.name == _SNP_CODE:
+            self.codes = df.index.values
+        else:
+            self.codes = np.arange(len(df))
+
+    def code(self, x):
+        '''
+        Returns x indexed by SNP codes. SNPs that are not in the index are dropped, since they
+        can't be in any merge with the data frame the index was built from. If that data frame
+        has duplicated rs numbers, x is returned unchanged.
+
+        '''
+        if not self.snps.is_unique:
+            return x
+
+        ii = self.snps.get_indexer(x.SNP)
+        keep = ii >= 0
+        x = x[keep]
+        x.index = pd.Index(self.codes[ii[keep]], name=_SNP_CODE)
+        return x
+
+
+def _join_codes(x, y):
+    '''Inner join of data frames indexed by SNP codes, in the order of x.'''
+    n_codes = max(x.index.max() if len(x) else 0, y.index.max() if len(y) else 0) + 1
+    y_row = np.full(n_codes, -1, dtype=np.int64)  # y_row[k] := row of code k in y
+    y_row[y.index.values] = np.arange(len(y))
+    iy = y_row[x.index.values]
+    ix = np.nonzero(iy >= 0)[0]
+    y = y.drop('SNP', axis=1).iloc[iy[ix]]
+    y.index = x.index[ix]
+    return pd.concat([x.iloc[ix], y], axis=1)
+
+
 def smart_merge(x, y):
-    '''Check if SNP columns are equal. If so, save time by using concat instead of merge.'''
-    if len(x) == len(y) and (x.index == y.index).all() and (x.SNP == y.SNP).all():
+    '''
+    Check if SNP columns are equal. If so, save time by using concat instead of merge. If x
+    and y are indexed by SNP codes (see SNPIndex), merge on the codes.
+
+    '''
+    coded = x.index.name == _SNP_CODE and y.index.name == _SNP_CODE
+    if len(x) == len(y) and (x.index == y.index).all() and (coded or (x.SNP == y.SNP).all()):
+        index = x.index
         x = x.reset_index(drop=True)
         y = y.reset_index(drop=True).drop('SNP', 1)
         out = pd.concat([x, y], axis=1)
+        if coded:
+            out.index = index
+    elif coded and len(x.columns.intersection(y.columns)) == 1:
+        out = _join_codes(x, y)
     else:
         out = pd.merge(x, y, how='inner', on='SNP')
     return out
@@ -79,7 +140,8 @@ def smart_merge(x, y):
 def _read_ref_ld(args, log):
     '''Read reference LD Scores.'''
     ref_ld = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                   'reference panel LD Score', ps.ldscore_fromlist)
+                                   'reference panel LD Score', ps.ldscore_fromlist,
+                                   threads=args.threads)
     log.log(
         'Read reference panel LD Scores for {N} SNPs.'.format(N=len(ref_ld)))
     return ref_ld
@@ -90,10 +152,12 @@ def _read_annot(args, log):
     try:
         if args.ref_ld is not None:
             overlap_matrix, M_tot = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                                          'annot matrix', ps.annot, frqfile=args.frqfile)
+                                                          'annot matrix', ps.annot, frqfile=args.frqfile,
+                                                          threads=args.threads)
         elif args.ref_ld_chr is not None:
             overlap_matrix, M_tot = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                                      'annot matrix', ps.annot, frqfile=args.frqfile_chr)
+                                                      'annot matrix', ps.annot, frqfile=args.frqfile_chr,
+                                                      threads=args.threads)
     except Exception:
         log.log('Error parsing .annot file.')
         raise
@@ -131,7 +195,8 @@ def _read_w_ld(args, log):
         raise ValueError(
             '--w-ld must point to a single fileset (no commas allowed).')
     w_ld = _read_chr_split_files(args.w_ld_chr, args.w_ld, log,
-                                 'regression weight LD Score', ps.ldscore_fromlist)
+                                 'regression weight LD Score', ps.ldscore_fromlist,
+                                 threads=args.threads)
     if len(w_ld.columns) != 2:
         raise ValueError('--w-ld may only have one LD Score column.')
     w_ld.columns = ['SNP', 'LD_weights']  # prevent colname conflicts w/ ref ld
@@ -226,6 +291,12 @@ def _print_part_delete_values(ldscore_reg, ofh, log):
     np.savetxt(ofh, ldscore_reg.part_delete_values)
 
 
+def _log_irwls(ldscore_reg, log):
+    '''Log IRWLS iteration counts and weight changes (nothing if fixed weights were used).'''
+    if ldscore_reg.irwls_fits:
+        log.log(ldscore_reg.irwls_summary())
+
+
 def _merge_and_log(ld, sumstats, noun, log):
     '''Wrap smart merge with log messages about # of SNPs.'''
     sumstats = smart_merge(ld, sumstats)
@@ -238,13 +309,29 @@ def _merge_and_log(ld, sumstats, noun, log):
     return sumstats
 
 
-def _read_ld_sumstats(args, log, fh, alleles=False, dropna=True):
-    sumstats = _read_sumstats(args, log, fh, alleles=alleles, dropna=dropna)
+def _read_ld(args, log):
+    '''
+    Read reference panel LD Scores, M and regression weight LD Scores. ref_ld and w_ld are
+    indexed by integer SNP codes (the positions of the SNPs in ref_ld); snp_index codes other
+    data frames the same way.
+
+    '''
     ref_ld = _read_ref_ld(args, log)
     n_annot = len(ref_ld.columns) - 1
     M_annot = _read_M(args, log, n_annot)
     M_annot, ref_ld, novar_cols = _check_variance(log, M_annot, ref_ld)
     w_ld = _read_w_ld(args, log)
+    # merge on integer SNP codes (the positions of the SNPs in ref_ld) instead of rs numbers
+    snp_index = SNPIndex(ref_ld)
+    ref_ld.index = pd.Index(snp_index.codes, name=_SNP_CODE)
+    w_ld = snp_index.code(w_ld)
+    return M_annot, ref_ld, w_ld, novar_cols, snp_index
+
+
+def _read_ld_sumstats(args, log, fh, alleles=False, dropna=True):
+    sumstats = _read_sumstats(args, log, fh, alleles=alleles, dropna=dropna)
+    M_annot, ref_ld, w_ld, novar_cols, snp_index = _read_ld(args, log)
+    sumstats = snp_index.code(sumstats)
     sumstats = _merge_and_log(ref_ld, sumstats, 'reference panel LD', log)
     sumstats = _merge_and_log(sumstats, w_ld, 'regression SNP LD', log)
     w_ld_cname = sumstats.columns[-1]
@@ -285,7 +372,8 @@ def cell_type_specific(args, log):
     results_data = []
     for (name, ct_ld_chr) in [x.split() for x in open(args.ref_ld_chr_cts).readlines()]:
         ref_ld_cts_allsnps = _read_chr_split_files(ct_ld_chr, None, log,
-                                   'cts reference panel LD Score', ps.ldscore_fromlist)
+                                   'cts reference panel LD Score', ps.ldscore_fromlist,
+                                   threads=args.threads)
         log.log('Performing regression.')
         ref_ld_cts = np.array(pd.merge(keep_snps, ref_ld_cts_allsnps, on='SNP', how='left').ix[:,1:])
         if np.any(np.isnan(ref_ld_cts)):
@@ -312,8 +400,8 @@ def cell_type_specific(args, log):
     log.log('Results printed to '+args.out+'.cell_type_results.txt')
 
 
-def estimate_h2(args, log):
-    '''Estimate h2 and partitioned h2.'''
+def _h2_args(args):
+    '''Copy args and cast the --h2 options.'''
     args = copy.deepcopy(args)
     if args.samp_prev is not None and args.pop_prev is not None:
         args.samp_prev, args.pop_prev = map(
@@ -322,8 +410,23 @@ def estimate_h2(args, log):
         args.intercept_h2 = float(args.intercept_h2)
     if args.no_intercept:
         args.intercept_h2 = 1
+    return args
+
+
+def estimate_h2(args, log):
+    '''Estimate h2 and partitioned h2.'''
+    args = _h2_args(args)
     M_annot, w_ld_cname, ref_ld_cnames, sumstats, novar_cols = _read_ld_sumstats(
         args, log, args.h2)
+    return _estimate_h2(args, log, M_annot, w_ld_cname, ref_ld_cnames, sumstats)
+
+
+def _estimate_h2(args, log, M_annot, w_ld_cname, ref_ld_cnames, sumstats, overlap=None):
+    '''
+    Estimate h2 from summary statistics merged with LD Scores. overlap is the output of
+    _read_annot; it is read if None and --overlap-annot is set.
+
+    '''
     ref_ld = np.array(sumstats[ref_ld_cnames])
     _check_ld_condnum(args, log, ref_ld_cnames)
     _warn_length(log, sumstats)
@@ -356,7 +459,8 @@ def estimate_h2(args, log):
 
     hsqhat = reg.Hsq(chisq, ref_ld, s(sumstats[w_ld_cname]), s(sumstats.N),
                      M_annot, n_blocks=n_blocks, intercept=args.intercept_h2,
-                     twostep=args.two_step, old_weights=old_weights)
+                     twostep=args.two_step, old_weights=old_weights,
+                     max_iter=args.irwls_max_iter, tol=args.irwls_tol)
 
     if args.print_cov:
         _print_cov(hsqhat, args.out + '.cov', log)
@@ -365,8 +469,11 @@ def estimate_h2(args, log):
         _print_part_delete_values(hsqhat, args.out + '.part_delete', log)
 
     log.log(hsqhat.summary(ref_ld_cnames, P=args.samp_prev, K=args.pop_prev, overlap = args.overlap_annot))
+    _log_irwls(hsqhat, log)
     if args.overlap_annot:
-        overlap_matrix, M_tot = _read_annot(args, log)
+        if overlap is None:
+            overlap = _read_annot(args, log)
+        overlap_matrix, M_tot = overlap
 
         # overlap_matrix = overlap_matrix[np.array(~novar_cols), np.array(~novar_cols)]#np.logical_not
         df_results = hsqhat._overlap_output(ref_ld_cnames, overlap_matrix, M_annot, M_tot, args.print_coefficients)
@@ -376,6 +483,137 @@ def estimate_h2(args, log):
     return hsqhat
 
 
+# LD Scores shared by the traits of a batch --h2 run. Set before the process pool is created, so
+# that forked workers inherit them instead of each receiving a pickled copy.
+_H2_BATCH_LD = {}
+_H2_BATCH_COLUMNS = ['trait', 'sumstats', 'n_snp', 'h2', 'h2_se', 'intercept', 'intercept_se',
+                     'ratio', 'ratio_se', 'lambda_gc', 'mean_chisq']
+
+
+class _TraitLog(object):
+    '''
+    Log for one trait of a batch --h2 run. Writes to its own file only, so that traits run in
+    parallel don't interleave on stdout.
+
+    '''
+    def __init__(self, fh):
+        self.log_fh = open(fh, 'wb')
+
+    def log(self, msg):
+        print >>self.log_fh, msg
+
+    def close(self):
+        self.log_fh.close()
+
+
+def _read_h2_manifest(fh):
+    '''
+    Read a --h2-batch manifest. Each non-empty line not starting with # has the path to a
+    .sumstats file and optionally a trait name, which defaults to the file name without the
+    .sumstats[.gz|.bz2] suffix. The output of each trait goes to <out>.<name>.log, so names
+    must be unique and cannot contain path separators. Returns a list of (name, path).
+
+    '''
+    traits = []
+    with open(fh) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) > 2:
+                raise ValueError(
+                    'Line {I} of {F} has more than two fields.'.format(I=i + 1, F=fh))
+            path = fields[0]
+            if len(fields) == 2:
+                name = fields[1]
+            else:
+                name = os.path.basename(path)
+                for suffix in ('.gz', '.bz2', '.sumstats'):
+                    if name.endswith(suffix):
+                        name = name[:-len(suffix)]
+            if name in ('', '.', '..') or os.sep in name or (os.altsep and os.altsep in name):
+                raise ValueError('Invalid trait name {N} on line {I} of {F}. Trait names '
+                                 'cannot contain path separators.'.format(N=name, I=i + 1, F=fh))
+            traits.append((name, path))
+
+    if len(traits) == 0:
+        raise ValueError('No summary statistics files listed in {F}.'.format(F=fh))
+    names = [name for name, _ in traits]
+    if len(set(names)) < len(names):
+        dups = sorted(set(x for x in names if names.count(x) > 1))
+        raise ValueError('Duplicated trait names in {F}: {D}.'.format(F=fh, D=', '.join(dups)))
+
+    return traits
+
+
+def _h2_batch_trait(args, name, fh):
+    '''
+    Estimate h2 for one trait of a batch --h2 run against the LD Scores in _H2_BATCH_LD. Logs
+    to <out>.<name>.log and returns a row of the combined results table.
+
+    '''
+    d = _H2_BATCH_LD
+    args = copy.deepcopy(args)
+    args.h2, args.out = fh, args.out + '.' + name
+    row = dict.fromkeys(_H2_BATCH_COLUMNS, 'NA')
+    row.update(trait=name, sumstats=fh)
+    log = _TraitLog(args.out + '.log')
+    try:
+        sumstats = _read_sumstats(args, log, fh, dropna=True)
+        sumstats = _merge_and_log(
+            d['ld'], d['snp_index'].code(sumstats), 'reference panel and regression SNP LD', log)
+        hsqhat = _estimate_h2(args, log, d['M_annot'], d['w_ld_cname'], d['ref_ld_cnames'],
+                              sumstats, d['overlap'])
+    except Exception:
+        log.log(traceback.format_exc())
+        return row
+    finally:
+        log.close()
+
+    row.update(n_snp=len(sumstats), h2=hsqhat.tot, h2_se=hsqhat.tot_se,
+               intercept=hsqhat.intercept, intercept_se=hsqhat.intercept_se,
+               ratio=getattr(hsqhat, 'ratio', 'NA'), ratio_se=getattr(hsqhat, 'ratio_se', 'NA'),
+               lambda_gc=hsqhat.lambda_gc, mean_chisq=hsqhat.mean_chisq)
+    return row
+
+
+def estimate_h2_batch(args, log):
+    '''
+    Estimate h2 for every trait in the --h2-batch manifest. The LD Scores are read and merged
+    once and shared by all traits, which are run in a pool of --threads processes. Each trait
+    is logged to <out>.<trait>.log, and the results are written to <out>.h2.results.
+
+    '''
+    args = _h2_args(args)
+    traits = _read_h2_manifest(args.h2_batch)
+    log.log('Read {N} summary statistics files from {F}.'.format(N=len(traits), F=args.h2_batch))
+    M_annot, ref_ld, w_ld, _, snp_index = _read_ld(args, log)
+    ld = _merge_and_log(ref_ld, w_ld, 'regression SNP LD', log)
+    overlap = _read_annot(args, log) if args.overlap_annot else None
+    _H2_BATCH_LD.update(ld=ld, snp_index=snp_index, M_annot=M_annot, overlap=overlap,
+                        w_ld_cname=ld.columns[-1], ref_ld_cnames=ref_ld.columns[1:])
+    del ref_ld, w_ld
+    try:
+        rows = ps.parallel_map(_h2_batch_trait, [(args, name, fh) for name, fh in traits],
+                               threads=args.threads)
+    finally:
+        _H2_BATCH_LD.clear()
+
+    results = pd.DataFrame(rows, columns=_H2_BATCH_COLUMNS)
+    failed = [row['trait'] for row in rows if row['h2'] == 'NA']
+    if len(failed) > 0:
+        log.log('h2 estimation failed for {N} traits (see the per-trait logs): {T}'.format(
+            N=len(failed), T=', '.join(failed)))
+    out_fname = args.out + '.h2.results'
+    results.to_csv(out_fname, sep='\t', index=False)
+    log.log('\nSummary of heritability results:\n' +
+            results.drop('sumstats', axis=1).to_string(header=True, index=False) + '\n')
+    log.log('Per-trait logs written to {O}.<trait>.log'.format(O=args.out))
+    log.log('Results printed to ' + out_fname)
+    return results
+
+
 def estimate_rg(args, log):
     '''Estimate rg between trait 1 and a list of other traits.'''
     args = copy.deepcopy(args)
@@ -395,6 +633,7 @@ def estimate_rg(args, log):
     out_prefix = args.out + rg_files[0]
     M_annot, w_ld_cname, ref_ld_cnames, sumstats, _ = _read_ld_sumstats(args, log, p1,
                                                                         alleles=True, dropna=True)
+    snp_index = SNPIndex(sumstats)  # shared by the merges with the other phenotypes
     RG = []
     n_annot = M_annot.shape[1]
     if n_annot == 1 and args.two_step is None and args.intercept_h2 is None:
@@ -406,7 +645,7 @@ def estimate_rg(args, log):
         log.log(
             'Computing rg for phenotype {I}/{N}'.format(I=i + 2, N=len(rg_paths)))
         try:
-            loop = _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames)
+            loop = _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames, snp_index)
             rghat = _rg(loop, args, log, M_annot, ref_ld_cnames, w_ld_cname, i)
             RG.append(rghat)
             _print_gencor(args, log, rghat, ref_ld_cnames, i, rg_paths, i == 0)
@@ -429,8 +668,10 @@ def estimate_rg(args, log):
     return RG
 
 
-def _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames):
+def _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames, snp_index=None):
     loop = _read_sumstats(args, log, p2, alleles=True, dropna=False)
+    if snp_index is not None:
+        loop = snp_index.code(loop)
     loop = _merge_sumstats_sumstats(args, sumstats, loop, log)
     loop = loop.dropna(how='any')
     alleles = loop.A1 + loop.A2 + loop.A1x + loop.A2x
@@ -482,12 +723,15 @@ def _print_gencor(args, log, rghat, ref_ld_cnames, i, rg_paths, print_hsq1):
     if print_hsq1:
         log.log(l('\nHeritability of phenotype 1\n'))
         log.log(rghat.hsq1.summary(ref_ld_cnames, P=P[0], K=K[0]))
+        _log_irwls(rghat.hsq1, log)
 
     log.log(
         l('\nHeritability of phenotype {I}/{N}\n'.format(I=i + 2, N=len(rg_paths))))
     log.log(rghat.hsq2.summary(ref_ld_cnames, P=P[1], K=K[1]))
+    _log_irwls(rghat.hsq2, log)
     log.log(l('\nGenetic Covariance\n'))
     log.log(rghat.gencov.summary(ref_ld_cnames, P=P, K=K))
+    _log_irwls(rghat.gencov, log)
     log.log(l('\nGenetic Correlation\n'))
     log.log(rghat.summary() + '\n')
 
@@ -534,7 +778,8 @@ def _rg(sumstats, args, log, M_annot, ref_ld_cnames, w_ld_cname, i):
                    ref_ld, s(sumstats[w_ld_cname]), s(
                        sumstats.N1), s(sumstats.N2), M_annot,
                    intercept_hsq1=intercepts[0], intercept_hsq2=intercepts[1],
-                   intercept_gencov=intercepts[2], n_blocks=n_blocks, twostep=args.two_step)
+                   intercept_gencov=intercepts[2], n_blocks=n_blocks, twostep=args.two_step,
+                   max_iter=args.irwls_max_iter, tol=args.irwls_tol)
 
     return rghat
 
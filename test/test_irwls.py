@@ -67,3 +67,67 @@ class Test_IRWLS_1D(unittest.TestCase):
         z = IRWLS(self.x, self.y, self.update_func, 2)
         assert_array_equal(z.est.shape, (1, 1))
         assert_array_almost_equal(z.est, 1)
+
+
+class Test_IRWLS_Gram(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(12)
+        n = 200
+        self.x = np.vstack([np.ones(n), np.random.uniform(1, 10, size=n)]).T
+        self.y = np.dot(self.x, [1, 0.5]).reshape((n, 1)) + np.random.normal(size=(n, 1))
+        self.w = np.random.uniform(0.5, 2, size=(n, 1))
+        self.update_func = lambda z: 1 / np.dot(self.x, np.abs(z[0]))
+
+    def test_wls_gram(self):
+        s = [0, 50, 120, 200]
+        assert_array_almost_equal(
+            IRWLS.wls_gram(self.x, self.y, self.w, s)[0],
+            IRWLS.wls(self.x, self.y, np.sqrt(self.w))[0])
+
+    def test_irwls_gram_eq_lstsq(self):
+        z = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, gram=True)
+        zl = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, gram=False)
+        assert_array_almost_equal(z.est, zl.est)
+        assert_array_almost_equal(z.jknife_cov, zl.jknife_cov)
+        assert_array_almost_equal(z.delete_values, zl.delete_values)
+        assert_array_equal(z.separators, zl.separators)
+
+    def test_gram_neg_weight(self):
+        assert_raises(ValueError, IRWLS, self.x, self.y, lambda z: -self.w, 10, gram=True)
+
+    def test_max_iter(self):
+        z = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, max_iter=5)
+        self.assertEqual(z.n_iter, 5)
+        self.assertEqual(len(z.w_deltas), 5)
+        assert_raises(ValueError, IRWLS, self.x, self.y, self.update_func, 10, max_iter=0)
+
+    def test_tol(self):
+        for gram in (True, False):
+            z = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, max_iter=100, tol=1e-10,
+                      gram=gram)
+            zl = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, max_iter=z.n_iter + 10,
+                       gram=gram)
+            self.assertLess(z.n_iter, 100)
+            self.assertLess(z.w_deltas[-1], 1e-10)
+            assert_array_almost_equal(z.est, zl.est)
+            assert_array_almost_equal(z.jknife_cov, zl.jknife_cov)
+
+    def test_tol_gram_eq_lstsq(self):
+        # a loose tol stops both paths early, and they must use the same final weights
+        for tol in [1e-1, 1e-3]:
+            z = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, max_iter=100, tol=tol,
+                      gram=True)
+            zl = IRWLS(self.x, self.y, self.update_func, 10, w=self.w, max_iter=100, tol=tol,
+                       gram=False)
+            self.assertEqual(z.n_iter, zl.n_iter)
+            assert_array_almost_equal(z.w_deltas, zl.w_deltas)
+            assert_array_almost_equal(z.est, zl.est, decimal=10)
+            assert_array_almost_equal(z.jknife_cov, zl.jknife_cov, decimal=10)
+
+    def test_zero_weight_delta(self):
+        w = self.w.copy()
+        w[0] = 0
+        with np.errstate(divide='raise', invalid='raise'):
+            self.assertGreater(IRWLS._check_update(w, self.w), 1)
+        self.assertEqual(IRWLS._check_update(self.w, self.w), 0)
@@ -44,6 +44,14 @@ class Test_Jackknife(unittest.TestCase):
         assert_array_equal(est.shape, (1, 2))
         assert_array_equal(se.shape, (1, 2))
 
+    def test_jknife_matrix(self):
+        pseudovalues = np.random.normal(size=(20, 3))
+        (est, var, se, cov) = jk.Jackknife.jknife(np.matrix(pseudovalues))
+        assert isinstance(est, np.matrix)
+        assert not isinstance(cov, np.matrix)
+        assert_array_almost_equal(cov, np.cov(pseudovalues.T, ddof=1) / 20)
+        assert_array_almost_equal(est, np.mean(pseudovalues, axis=0).reshape((1, 3)))
+
     def test_delete_to_pseudo(self):
         for dim in [1, 2]:
             est = np.ones((1, dim))
@@ -200,6 +208,22 @@ class Test_LsqtsqJackknifeFast(unittest.TestCase):
             b2 = jk.LstsqJackknifeSlow(x, y, n_blocks=n_blocks).est
             assert_array_almost_equal(b1, b2)
 
+    def test_delete_values_eq_slow(self):
+        x = np.random.normal(size=(100, 3))
+        y = np.random.normal(size=(100, 1))
+        batch_size = jk._SOLVE_BATCH_SIZE
+        try:
+            for jk._SOLVE_BATCH_SIZE in [batch_size, 20]:  # all blocks / 2 blocks per batch
+                for n_blocks in [2, 7, 50]:
+                    d1 = jk.LstsqJackknifeFast(x, y, n_blocks=n_blocks).delete_values
+                    d2 = jk.LstsqJackknifeSlow(x, y, n_blocks=n_blocks).delete_values
+                    assert_array_almost_equal(d1, d2)
+                    d3 = jk.LstsqJackknifeFast(np.matrix(x), np.matrix(y),
+                                               n_blocks=n_blocks).delete_values
+                    assert_array_almost_equal(d1, d3)
+        finally:
+            jk._SOLVE_BATCH_SIZE = batch_size
+
     def test_bad_data(self):
         x = np.arange(6).reshape((1, 6))
         assert_raises(ValueError, jk.LstsqJackknifeFast, x, x, n_blocks=3)
@@ -265,3 +289,19 @@ class Test_RatioJackknife(unittest.TestCase):
         denom_delete_vals[9, 0] = 0
         assert_raises(FloatingPointError, jk.RatioJackknife,
                       est, numer_delete_vals, denom_delete_vals)
+
+    def test_batch(self):
+        est = np.random.normal(size=(4, 3, 1, 2))
+        numer = np.random.normal(size=(4, 3, 10, 2))
+        denom = np.random.normal(size=(4, 3, 10, 2))
+        jknife = jk.RatioJackknife(est, numer, denom)
+        assert_array_equal(jknife.jknife_cov.shape, (4, 3, 2, 2))
+        for i in xrange(4):
+            for j in xrange(3):
+                x = jk.RatioJackknife(est[i, j], numer[i, j], denom[i, j])
+                assert_array_almost_equal(jknife.pseudovalues[i, j], x.pseudovalues)
+                assert_array_almost_equal(jknife.jknife_est[i, j], x.jknife_est)
+                assert_array_almost_equal(jknife.jknife_se[i, j], x.jknife_se)
+                assert_array_almost_equal(jknife.jknife_cov[i, j],
+                                          np.cov(x.pseudovalues.T) / 10)
+        assert_raises(ValueError, jk.RatioJackknife, est[0], numer, denom)
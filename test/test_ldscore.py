@@ -2,7 +2,12 @@ import ldscore.ldscore as ld
 import unittest
 import bitarray as ba
 import numpy as np
+from scipy import sparse
 import nose
+import tempfile
+import os
+from itertools import product
+from nose.tools import assert_raises
 import ldscore.parse as ps
 
 
@@ -15,6 +20,16 @@ def test_getBlockLefts():
     for coords, max_dist, correct in l:
         assert np.all(ld.getBlockLefts(coords, max_dist) == correct)
 
+    # cM coordinates where coords[j] - max_dist rounds differently than coords[j] - coords[k]
+    coords = np.round(np.cumsum(np.random.rand(1000) / 10), 1)
+    for max_dist in [0, 0.1, 0.3, 1]:
+        block_left = ld.getBlockLefts(coords, max_dist)
+        assert block_left.dtype.kind == 'i'
+        for j in xrange(len(coords)):
+            correct = min(k for k in xrange(len(coords))
+                          if abs(coords[j] - coords[k]) <= max_dist)
+            assert block_left[j] == correct
+
 
 def test_block_left_to_right():
     l = [
@@ -25,6 +40,7 @@ def test_block_left_to_right():
     for block_left, correct_answer in l:
         block_right = ld.block_left_to_right(block_left)
         assert np.all(block_right == correct_answer)
+        assert block_right.dtype.kind == 'i'
 
 
 class test_bed(unittest.TestCase):
@@ -51,6 +67,14 @@ class test_bed(unittest.TestCase):
             [0.59999999999999998, 0.59999999999999998, 0.625, 0.625])
         assert np.all(bed.freq == correct)
 
+    def test_packed_missing(self):
+        # the packed engine with missing genotypes (the reference panel has none)
+        for block_left, c in product([np.zeros(4, dtype=int), np.array([0, 0, 1, 2])], [1, 2]):
+            bed = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim)
+            l2 = bed.ldScoreVarBlocks(block_left, c)
+            bed._currentSNP = 0
+            assert np.allclose(bed.ldScoreVarBlocks(block_left, c, packed=True), l2)
+
     def test_filter_snps(self):
         keep_snps = [1, 4]
         bed = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim,
@@ -70,6 +94,16 @@ class test_bed(unittest.TestCase):
         assert bed.geno[0:4] == ba.bitarray('0001')
         assert bed.geno[8:12] == ba.bitarray('0001')
 
+    def test_filter_indivs_pad(self):
+        keep_indivs = [4, 0, 1]
+        bed = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim,
+                              keep_indivs=keep_indivs)
+        assert bed.nru == 4
+        assert len(bed.geno) == 2*bed.m*bed.nru
+        # the pad bits are set to zero
+        for j in xrange(bed.m):
+            assert not bed.geno[2*j*bed.nru+6:2*(j+1)*bed.nru].any()
+
     def test_filter_indivs_and_snps(self):
         keep_indivs = [0, 1]
         keep_snps = [1, 5]
@@ -80,6 +114,17 @@ class test_bed(unittest.TestCase):
         print bed.geno
         assert bed.geno[0:4] == ba.bitarray('0001')
 
+    def test_filter_snps_maf(self):
+        # compare the counts from packed bytes with counts from decoded genotypes
+        for keep_indivs in [None, [0, 1, 3], [4, 2, 0]]:
+            for mafMin in [None, 0.2]:
+                bed = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim,
+                                      keep_indivs=keep_indivs, mafMin=mafMin)
+                bed_mm = ld.PlinkBEDFileMemmap('test/plink_test/plink.bed', self.N, self.bim,
+                                               keep_indivs=keep_indivs, mafMin=mafMin)
+                assert bed.kept_snps == bed_mm.kept_snps
+                assert bed.freq == bed_mm.freq
+
     @nose.tools.raises(ValueError)
     def test_bad_filename(self):
         bed = ld.PlinkBEDFile('test/plink_test/plink.bim', 9, self.bim)
@@ -109,3 +154,318 @@ class test_bed(unittest.TestCase):
         bed._currentSNP -= b
         y = bed.nextSNPs(b, minorRef=True)
         assert np.all(x == -y)
+
+    def test_nextSNPs_bedcode(self):
+        # decoding whole bytes through the lookup table must agree with decoding bit pairs
+        bedcode = {2: ba.bitarray('11'), 9: ba.bitarray('10'), 1: ba.bitarray('01'),
+                   0: ba.bitarray('00')}
+        bed = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim)
+        x = bed.nextSNPs(bed.m)
+        for j in xrange(bed.m):
+            z = bed.geno[2*j*bed.nru:2*(j+1)*bed.nru]
+            snp = np.array(z.decode(bedcode), dtype='float64')[0:bed.n]
+            ii = snp != 9
+            avg = np.mean(snp[ii])
+            snp[np.logical_not(ii)] = avg
+            assert np.all(x[:, j] == (snp - avg) / np.std(snp))
+
+
+class test_bed_memmap(unittest.TestCase):
+
+    def setUp(self):
+        self.M = 8
+        self.N = 5
+        self.bim = ps.PlinkBIMFile('test/plink_test/plink.bim')
+
+    def test_bed(self):
+        bed = ld.PlinkBEDFileMemmap('test/plink_test/plink.bed', self.N, self.bim)
+        bed_mem = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim)
+        assert bed.m == bed_mem.m
+        assert bed.n == bed_mem.n
+        assert np.all(bed.kept_snps == bed_mem.kept_snps)
+        assert np.all(bed.freq == bed_mem.freq)
+        # the whole file stays on disk
+        assert bed.geno.shape == (self.M, 2)
+        assert np.all(bed.nextSNPs(bed.m) == bed_mem.nextSNPs(bed_mem.m))
+
+    def test_filter_snps(self):
+        keep_snps = [1, 4]
+        bed = ld.PlinkBEDFileMemmap('test/plink_test/plink.bed', self.N, self.bim,
+                                    keep_snps=keep_snps)
+        assert bed.m == 1
+        assert bed.n == 5
+        assert bed.kept_snps == [4]
+
+    def test_filter_indivs_and_snps(self):
+        keep_indivs = [0, 1]
+        keep_snps = [1, 5]
+        bed = ld.PlinkBEDFileMemmap('test/plink_test/plink.bed', self.N, self.bim,
+                                    keep_snps=keep_snps, keep_indivs=keep_indivs)
+        assert bed.m == 1
+        assert bed.n == 2
+        assert bed.nextSNPs(1).shape == (2, 1)
+
+    def test_ldscore(self):
+        block_left = ld.getBlockLefts(np.arange(4), 2)
+        bed = ld.PlinkBEDFileMemmap('test/plink_test/plink.bed', self.N, self.bim)
+        bed_mem = ld.PlinkBEDFile('test/plink_test/plink.bed', self.N, self.bim)
+        assert np.all(bed.ldScoreVarBlocks(block_left, 1) ==
+                      bed_mem.ldScoreVarBlocks(block_left, 1))
+
+    @nose.tools.raises(ValueError)
+    def test_bad_filename(self):
+        bed = ld.PlinkBEDFileMemmap('test/plink_test/plink.bim', 9, self.bim)
+
+
+class test_ldScoreVarBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.bim = ps.PlinkBIMFile('test/reference_test/plink.bim')
+        self.N = 379
+        bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+        x = bed.nextSNPs(bed.m)
+        r = np.dot(x.T, x) / self.N
+        self.r2 = np.square(r) - (1 - np.square(r)) / (self.N - 2)
+        self.coords = np.array(self.bim.df['BP'])
+
+    def brute_force(self, block_left):
+        m = len(block_left)
+        l2 = np.zeros(m)
+        for j in xrange(m):
+            for k in xrange(m):
+                if block_left[max(j, k)] <= min(j, k):
+                    l2[j] += self.r2[j, k]
+
+        return l2
+
+    def test_windows(self):
+        # windows that slide, shrink to zero at sequence gaps and span the whole chromosome
+        for max_dist in [0, 500, 1000, 5000, 50000]:
+            block_left = ld.getBlockLefts(self.coords, max_dist)
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            l2 = bed.ldScoreVarBlocks(block_left, 1)
+            assert np.allclose(l2[:, 0], self.brute_force(block_left))
+
+    def test_chunks(self):
+        block_left = np.zeros(10)
+        for c in [1, 2, 3, 4, 7, 10]:
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            l2 = bed.ldScoreVarBlocks(block_left, c)
+            assert np.allclose(l2[:, 0], np.sum(self.r2, axis=1))
+
+    def test_threads(self):
+        for max_dist in [0, 1000, 50000]:
+            block_left = ld.getBlockLefts(self.coords, max_dist)
+            for c in [1, 3]:
+                bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+                l2 = bed.ldScoreVarBlocks(block_left, c)
+                for threads in [2, 3]:
+                    bed._currentSNP = 0
+                    assert np.all(bed.ldScoreVarBlocks(block_left, c, threads=threads) == l2)
+
+    def test_precision(self):
+        # float32 L2 should be within 1e-5 of float64 L2 on the bundled test data
+        for fname, n, bim in [('test/plink_test/plink', 5, 'test/plink_test/plink.bim'),
+                              ('test/reference_test/plink', self.N, self.bim)]:
+            if isinstance(bim, str):
+                bim = ps.PlinkBIMFile(bim)
+
+            bed = ld.PlinkBEDFile(fname + '.bed', n, bim)
+            block_left = ld.getBlockLefts(np.arange(bed.m), 3)
+            l2 = bed.ldScoreVarBlocks(block_left, 2)
+            bed._currentSNP = 0
+            l2_32 = bed.ldScoreVarBlocks(block_left, 2, precision='float32')
+            assert l2_32.dtype == np.float64
+            assert np.max(np.abs(l2_32 - l2)) < 1e-5
+
+    def test_sparse_annot(self):
+        annot = np.zeros((10, 2))
+        annot[[1, 8], 0] = 1
+        annot[4, 1] = 0.5
+        for max_dist in [0, 1000, 5000, 50000]:
+            block_left = ld.getBlockLefts(self.coords, max_dist)
+            for c in [1, 2, 3]:
+                bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+                l2 = bed.ldScoreVarBlocks(block_left, c, annot=annot)
+                bed._currentSNP = 0
+                l2_sparse = bed.ldScoreVarBlocks(block_left, c, annot=sparse.csr_matrix(annot))
+                assert np.allclose(l2, l2_sparse)
+
+    def test_band(self):
+        annot = np.random.rand(10, 2)
+        for max_dist in [0, 1000, 50000]:
+            block_left = ld.getBlockLefts(self.coords, max_dist)
+            for c in [1, 3]:
+                bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+                l2 = bed.ldScoreVarBlocks(block_left, c, annot=annot)
+                bed._currentSNP = 0
+                l2_1, band = bed.ldScoreBand(block_left, c)
+                bed._currentSNP = 0
+                assert np.all(l2_1 == bed.ldScoreVarBlocks(block_left, c))
+                # the band is stored with float16 precision
+                assert np.max(np.abs(ld.band_cor_sum(band, annot) - l2)) < 1e-3
+                assert np.max(np.abs(ld.band_cor_sum(band)[:, 0] - l2_1[:, 0])) < 1e-3
+                bed._currentSNP = 0
+                assert np.all(bed.ldScoreBand(block_left, c, threads=2)[1].toarray() ==
+                              band.toarray())
+                # the LD Scores returned with the band are not rounded
+                bed._currentSNP = 0
+                assert np.all(bed.ldScoreBand(block_left, c, annot=annot)[0] == l2)
+                bed._currentSNP = 0
+                assert np.all(bed.ldScoreBand(block_left, c, annot=annot, threads=3)[0] == l2)
+                # the band holds every pair of SNPs in the same window
+                bed._currentSNP = 0
+                r2 = bed.__l2_unbiased__(np.corrcoef(bed.nextSNPs(10).T), self.N)
+                i, j = np.tril_indices(10)
+                in_window = j >= block_left[i]
+                dense = band.toarray()
+                assert np.allclose(dense[i[in_window], j[in_window]],
+                                   r2[i[in_window], j[in_window]], atol=1e-3)
+                assert np.all(np.triu(dense, 1) == 0)
+
+    def test_tune_chunk_size(self):
+        bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+        # whole-chromosome windows
+        assert bed.tuneChunkSize(np.zeros(10, dtype=int), candidates=(3, 1, 2)) == 1
+        block_left = ld.getBlockLefts(np.arange(10), 1)
+        assert bed.tuneChunkSize(block_left, candidates=(1, 2)) in (1, 2)
+        assert bed._currentSNP == 0
+        # too few SNPs to time two chunks of 4
+        assert bed.tuneChunkSize(block_left, candidates=(4, 5)) == 4
+
+    def test_packed(self):
+        annot = np.random.rand(10, 2)
+        words = ld._POPCOUNT_WORDS
+        for max_dist, c, ld._POPCOUNT_WORDS in product([0, 1000, 50000], [1, 3], [words, 1]):
+            block_left = ld.getBlockLefts(self.coords, max_dist)
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            l2 = bed.ldScoreVarBlocks(block_left, c, annot=annot)
+            bed._currentSNP = 0
+            assert np.allclose(bed.ldScoreVarBlocks(block_left, c, annot=annot, packed=True),
+                               l2)
+
+        ld._POPCOUNT_WORDS = words
+
+    def test_and_popcount(self):
+        x = np.random.randint(0, 2**62, size=(3, 5)).astype('uint64')
+        y = np.random.randint(0, 2**62, size=(3, 4)).astype('uint64')
+        pc = lambda z: sum(bin(int(w)).count('1') for w in z)
+        z = np.array([[pc(x[:, j] & y[:, k]) for k in xrange(4)] for j in xrange(5)])
+        words = ld._POPCOUNT_WORDS
+        for ld._POPCOUNT_WORDS in [words, 7, 1]:
+            assert np.array_equal(ld._and_popcount(x, y), z)
+            assert np.array_equal(ld._and_popcount(x, y, jj=[4, 1], kk=[2]), z[[4, 1]][:, [2]])
+
+        ld._POPCOUNT_WORDS = words
+
+    def test_packed_keep_indivs(self):
+        keep_indivs = range(0, self.N, 3)
+        block_left = ld.getBlockLefts(self.coords, 5000)
+        for cls in [ld.PlinkBEDFile, ld.PlinkBEDFileMemmap]:
+            bed = cls('test/reference_test/plink.bed', self.N, self.bim,
+                      keep_indivs=keep_indivs)
+            l2 = bed.ldScoreVarBlocks(block_left, 2)
+            bed._currentSNP = 0
+            assert np.allclose(bed.ldScoreVarBlocks(block_left, 2, packed=True), l2)
+
+    def test_resume(self):
+        annot = np.random.rand(10, 2)
+        block_left = ld.getBlockLefts(self.coords, 5000)
+        fname = os.path.join(tempfile.mkdtemp(), 'test.l2.ckpt.npz')
+        for c, n_calls in product([1, 2], [1, 2]):
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            l2 = bed.ldScoreVarBlocks(block_left, c, annot=annot)
+            # interrupt a run with a checkpoint before every chunk after n_calls reads
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            next_snps = bed.nextSNPs
+            calls = []
+
+            def interrupted(b):
+                calls.append(b)
+                if len(calls) > n_calls:
+                    raise KeyboardInterrupt
+
+                return next_snps(b)
+
+            bed.nextSNPs = interrupted
+            assert_raises(KeyboardInterrupt, bed.ldScoreVarBlocks, block_left, c, annot=annot,
+                checkpoint=(fname, -1))
+            assert os.path.exists(fname)
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            l2_resumed = bed.ldScoreVarBlocks(block_left, c, annot=annot,
+                checkpoint=(fname, -1), resume=True)
+            assert np.array_equal(l2_resumed, l2)
+            # a checkpoint from a different computation
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim)
+            assert_raises(ValueError, bed.ldScoreVarBlocks, block_left, c, annot=annot[:, :1],
+                checkpoint=(fname, -1), resume=True)
+            os.remove(fname)
+
+    def test_resume_changed_file(self):
+        # a checkpoint is not resumed after the genotype file changes
+        tmp = tempfile.mkdtemp()
+        bed_fname, fname = os.path.join(tmp, 'plink.bed'), os.path.join(tmp, 'test.l2.ckpt.npz')
+        with open('test/reference_test/plink.bed', 'rb') as f, open(bed_fname, 'wb') as g:
+            g.write(f.read())
+
+        block_left = ld.getBlockLefts(self.coords, 5000)
+        bed = ld.PlinkBEDFile(bed_fname, self.N, self.bim)
+        next_snps = bed.nextSNPs
+        calls = []
+
+        def interrupted(b):
+            calls.append(b)
+            if len(calls) > 1:
+                raise KeyboardInterrupt
+
+            return next_snps(b)
+
+        bed.nextSNPs = interrupted
+        assert_raises(KeyboardInterrupt, bed.ldScoreVarBlocks, block_left, 1,
+            checkpoint=(fname, -1))
+        st = os.stat(bed_fname)
+        os.utime(bed_fname, (st.st_atime, st.st_mtime + 10))
+        bed = ld.PlinkBEDFile(bed_fname, self.N, self.bim)
+        assert_raises(ValueError, bed.ldScoreVarBlocks, block_left, 1,
+            checkpoint=(fname, -1), resume=True)
+
+
+class test_dosage(unittest.TestCase):
+
+    def setUp(self):
+        self.bim = ps.PlinkBIMFile('test/dosage_test/plink.bim')
+        self.N = 379
+
+    def test_hard_calls(self):
+        # test/dosage_test/plink.dos holds the hard calls of test/reference_test/plink.bed
+        for keep_indivs in [None, range(0, self.N, 2)]:
+            dos = ld.DosageFile('test/dosage_test/plink.dos', self.N, self.bim,
+                                keep_indivs=keep_indivs, mafMin=0.1)
+            bed = ld.PlinkBEDFile('test/reference_test/plink.bed', self.N, self.bim,
+                                  keep_indivs=keep_indivs, mafMin=0.1)
+            assert dos.kept_snps == bed.kept_snps
+            assert np.allclose(dos.freq, bed.freq)
+            block_left = ld.getBlockLefts(np.array(self.bim.df['BP'])[dos.kept_snps], 5000)
+            assert np.allclose(dos.ldScoreVarBlocks(block_left, 3),
+                               bed.ldScoreVarBlocks(block_left, 3))
+
+    def test_dosages(self):
+        x = np.random.uniform(0, 2, (4, 50))
+        x[0, 0:5] = np.nan
+        x[3, :] = 1  # constant
+        fh = tempfile.NamedTemporaryFile(suffix='.dos')
+        ld.write_dosage(fh.name, x)
+        bim = ps.PlinkBIMFile('test/plink_test/plink.bim')
+        bim.IDList = bim.IDList.iloc[0:4]
+        bim.df = bim.df.iloc[0:4]
+        dos = ld.DosageFile(fh.name, 50, bim)
+        assert dos.kept_snps == [0, 1, 2]
+        z = np.round(x[0:3]*32767) / 32767
+        z[0, 0:5] = np.nanmean(z[0])
+        assert np.allclose(dos.freq, np.mean(z, axis=1) / 2)
+        z = (z - np.mean(z, axis=1)[:, np.newaxis]) / np.std(z, axis=1)[:, np.newaxis]
+        assert np.allclose(dos.nextSNPs(3), z.T)
+
+    @nose.tools.raises(ValueError)
+    def test_bad_filename(self):
+        ld.DosageFile('test/dosage_test/plink.bim', self.N, self.bim)
@@ -1,6 +1,8 @@
 from __future__ import division
 import munge_sumstats as munge
 import unittest
+import os
+import tempfile
 import numpy as np
 import pandas as pd
 import nose
@@ -310,7 +312,7 @@ class test_end_to_end(unittest.TestCase):
     def setUp(self):
         self.args = munge.parser.parse_args('')
         self.args.sumstats = 'test/munge_test/sumstats'
-        self.args.out = 'asdf'
+        self.args.out = os.path.join(tempfile.mkdtemp(), 'asdf')
         self.args.daner = True
 
     def test_basic(self):
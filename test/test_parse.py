@@ -5,8 +5,11 @@ import numpy as np
 import pandas as pd
 import nose
 import os
+import shutil
+import tempfile
 from nose.tools import *
 from numpy.testing import assert_array_equal, assert_array_almost_equal
+from pandas.util.testing import assert_frame_equal
 
 DIR = os.path.dirname(__file__)
 
@@ -68,6 +71,27 @@ class Test_ldscore(unittest.TestCase):
         assert_equal(list(x['AL2']), range(1, 3))
         assert_equal(list(x['BL2']), range(2, 6, 2))
 
+    def test_l2_parser(self):
+        x = ps.l2_parser(os.path.join(DIR, 'parse_test/test.l2.ldscore.gz'), 'gzip')
+        assert_array_equal(x.columns, ['CHR', 'SNP', 'BP', 'AL2', 'BL2'])
+        assert_equal(x.AL2.dtype, np.float64)
+        # missing values and non-numeric chromosomes are parsed the slow way
+        fh = os.path.join(tempfile.mkdtemp(), 'test.l2.ldscore')
+        with open(fh, 'w') as f:
+            f.write('CHR\tSNP\tBP\tL2\n2\trs1\t5\t.\nX\trs2\t1\t2.5\n1\trs3\t3\t1\n')
+        x = ps.l2_parser(fh, None)
+        assert_array_equal(x.CHR, ['2', 'X', '1'])
+        assert np.isnan(x.L2[0])
+        x = ps.ldscore(fh[:-len('.l2.ldscore')])
+        assert_array_equal(x.SNP, ['rs3', 'rs1', 'rs2'])
+
+    def test_ldscore_threads(self):
+        fh = os.path.join(DIR, 'parse_test/test')
+        x = ps.ldscore(fh, 2, threads=2)
+        assert_frame_equal(x, ps.ldscore(fh, 2))
+        x = ps.ldscore_fromlist([fh, fh], 2, threads=2)
+        assert_frame_equal(x, ps.ldscore_fromlist([fh, fh], 2))
+
     def test_ldscore_fromlist(self):
         fh = os.path.join(DIR, 'parse_test/test')
         x = ps.ldscore_fromlist([fh, fh])
@@ -79,6 +103,45 @@ class Test_ldscore(unittest.TestCase):
             ValueError, ps.ldscore_fromlist, [fh, os.path.join(DIR, 'parse_test/test2')])
 
 
+class Test_ldscore_bin(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.x = ps.read_csv(os.path.join(DIR, 'parse_test/test.l2.ldscore.gz'), header=0,
+                             compression='gzip')
+        self.x['CHR'] = [1] * 11 + [2] * 11
+        self.fh = os.path.join(self.dir, 'test')
+        ps.write_ldscore_bin(self.fh + '.l2.ldscore.bin', self.x, [1000, 2000, 3000.5],
+                             [10, 20, 30])
+
+    def test_read(self):
+        y = ps.read_ldscore_bin(self.fh + '.l2.ldscore.bin')
+        assert_array_equal(y.columns, self.x.columns)
+        for c in self.x.columns:
+            assert_array_equal(y[c], self.x[c])
+        y = ps.read_ldscore_bin(self.fh + '.l2.ldscore.bin', chr=2)
+        for c in self.x.columns:
+            assert_array_equal(y[c], self.x[c][11:])
+        assert_raises(ValueError, ps.read_ldscore_bin, self.fh + '.l2.ldscore.bin', chr=3)
+
+    def test_ldscore(self):
+        y = ps.ldscore(self.fh)
+        z = self.x.sort_values(by=['CHR', 'BP']).drop(['CHR', 'BP', 'CM', 'MAF'], axis=1)
+        assert_array_equal(y.columns, z.columns)
+        assert_array_equal(y.SNP, z.SNP)
+        assert_array_almost_equal(y.ix[:, 1:], z.ix[:, 1:])
+        assert_array_equal(ps.M(self.fh), [[1000, 2000, 3000.5]])
+        assert_array_equal(ps.M(self.fh, common=True), [[10, 20, 30]])
+        # a text file next to the .bin file is ambiguous
+        shutil.copy(os.path.join(DIR, 'parse_test/test.l2.ldscore.gz'),
+                    self.fh + '.l2.ldscore.gz')
+        assert_raises(ValueError, ps.ldscore, self.fh)
+
+    def test_bad_file(self):
+        assert_raises(ValueError, ps.ldscore_bin_footer,
+                      os.path.join(DIR, 'parse_test/test.l2.ldscore.gz'))
+
+
 class Test_M(unittest.TestCase):
 
     def test_bad_M(self):
@@ -98,6 +98,14 @@ class Test_Hsq_1D(unittest.TestCase):
         assert_array_almost_equal(reg.Hsq.weights(self.ld, self.w_ld, self.N, self.M, 0),
                                   reg.Hsq.weights(self.ld, self.w_ld, self.N, self.M, -1))
 
+    def test_irwls_summary(self):
+        hsq = reg.Hsq(self.chisq, self.ld, self.w_ld, self.N, self.M, n_blocks=3, intercept=1,
+                      max_iter=5, tol=1e-8)
+        assert_equal(len(hsq.irwls_fits), 1)
+        assert hsq.irwls_fits[0].n_iter <= 5
+        assert 'IRWLS: ' in hsq.irwls_summary()
+        assert_array_almost_equal(hsq.tot, self.hsq.tot)
+
     def test_summarize_chisq(self):
         chisq = np.arange(100).reshape((100, 1))
         mean_chisq, lambda_gc = self.hsq._summarize_chisq(chisq)
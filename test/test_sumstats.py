@@ -9,9 +9,12 @@ from nose.tools import *
 from numpy.testing import assert_array_equal, assert_array_almost_equal, assert_allclose
 from nose.plugins.attrib import attr
 import os
+import shutil
+import tempfile
 from ldsc import parser
 
 DIR = os.path.dirname(__file__)
+OUT = tempfile.mkdtemp()  # output of the tests
 N_REP = 200
 s._N_CHR = 2  # having to mock 22 files is annoying
 
@@ -84,6 +87,42 @@ def test_read_annot():
     assert_array_equal(M_tot, 2)
 
 
+def test_read_annot_chr():
+    tmp = tempfile.mkdtemp()
+    for i in [1, 2]:
+        shutil.copy(os.path.join(DIR, 'annot_test/test.annot'),
+                    os.path.join(tmp, 'test{i}.annot'.format(i=i)))
+        shutil.copy(os.path.join(DIR, 'annot_test/test1.frq'),
+                    os.path.join(tmp, 'frq{i}.frq'.format(i=i)))
+    ref_ld_chr = os.path.join(tmp, 'test')
+    for threads in [1, 2]:
+        overlap_matrix, M_tot = s._read_chr_split_files(ref_ld_chr, None, log, 'annot matrix',
+                                                        ps.annot, frqfile=None, threads=threads)
+        assert_array_equal(overlap_matrix, [[2, 0, 0], [0, 4, 4], [0, 4, 4]])
+        assert_array_equal(M_tot, 6)
+        overlap_matrix, M_tot = s._read_chr_split_files(ref_ld_chr, None, log, 'annot matrix',
+                                                        ps.annot, threads=threads,
+                                                        frqfile=os.path.join(tmp, 'frq'))
+        assert_array_equal(overlap_matrix, [[2, 0, 0], [0, 2, 2], [0, 2, 2]])
+        assert_array_equal(M_tot, 4)
+
+
+def test_smart_merge_codes():
+    ref = pd.DataFrame({'SNP': ['rs1', 'rs2', 'rs3', 'rs4'], 'L2': [1., 2, 3, 4]})
+    ss = pd.DataFrame({'SNP': ['rs4', 'rs5', 'rs2', 'rs1'], 'Z': [4., 5, 2, 1]})
+    w = pd.DataFrame({'SNP': ['rs2', 'rs4', 'rs3'], 'W': [2., 4, 3]})
+    correct = pd.merge(pd.merge(ref, ss, how='inner', on='SNP'), w, how='inner', on='SNP')
+    snp_index = s.SNPIndex(ref)
+    ref.index = pd.Index(snp_index.codes, name=s._SNP_CODE)
+    ss, w = snp_index.code(ss), snp_index.code(w)
+    assert_array_equal(ss.index, [3, 1, 0])
+    x = s.smart_merge(s.smart_merge(ref, ss), w)
+    assert_array_equal(x.index, [1, 3])
+    assert_frame_equal(x.reset_index(drop=True), correct)
+    # aligned codes use concat
+    assert_frame_equal(s.smart_merge(x, x[['SNP']]), x)
+
+
 def test_valid_snps():
     x = {'AC', 'AG', 'CA', 'CT', 'GA', 'GT', 'TC', 'TG'}
     assert_equal(x, s.VALID_SNPS)
@@ -202,7 +241,7 @@ class Test_RG_Statistical():
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.rg = ','.join(
             (DIR + '/simulate_test/sumstats/' + str(i) for i in xrange(N_REP)))
-        args.out = DIR + '/simulate_test/1'
+        args.out = os.path.join(OUT, '1')
         x = s.estimate_rg(args, log)
         args.intercept_gencov = ','.join(('0' for _ in xrange(N_REP)))
         args.intercept_h2 = ','.join(('1' for _ in xrange(N_REP)))
@@ -289,7 +328,7 @@ class Test_H2_Statistical(unittest.TestCase):
         for i in xrange(N_REP):
             args.intercept_h2 = None
             args.h2 = DIR + '/simulate_test/sumstats/' + str(i)
-            args.out = DIR + '/simulate_test/1'
+            args.out = os.path.join(OUT, '1')
             h2.append(s.estimate_h2(args, log))
             args.intercept_h2 = 1
             h2_noint.append(s.estimate_h2(args, log))
@@ -366,7 +405,7 @@ class Test_Estimate(unittest.TestCase):
         args.ref_ld = DIR + '/simulate_test/ldscore/oneld_onefile'
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.h2 = DIR + '/simulate_test/sumstats/1'
-        args.out = DIR + '/simulate_test/1'
+        args.out = os.path.join(OUT, '1')
         args.print_cov = True  # right now just check no runtime errors
         args.print_delete_vals = True
         x = s.estimate_h2(args, log)
@@ -385,7 +424,7 @@ class Test_Estimate(unittest.TestCase):
         args.ref_ld_chr = DIR + '/simulate_test/ldscore/twold_onefile'
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.h2 = DIR + '/simulate_test/sumstats/555'
-        args.out = DIR + '/simulate_test/'
+        args.out = OUT + '/'
         x = s.estimate_h2(args, log)
         args.ref_ld = DIR + '/simulate_test/ldscore/twold_firstfile,' + \
             DIR + '/simulate_test/ldscore/twold_secondfile'
@@ -403,6 +442,56 @@ class Test_Estimate(unittest.TestCase):
         assert_array_almost_equal(x.prop_se, y.prop_se)
         assert_array_almost_equal(y.coef_se, z.coef_se)
 
+    def test_h2_batch(self):
+        tmp = tempfile.mkdtemp()
+        args = parser.parse_args('')
+        args.ref_ld = DIR + '/simulate_test/ldscore/oneld_onefile'
+        args.w_ld = DIR + '/simulate_test/ldscore/w'
+        args.h2_batch = os.path.join(tmp, 'manifest')
+        args.out = os.path.join(tmp, 'batch')
+        with open(args.h2_batch, 'w') as f:
+            f.write('# comment\n' + DIR + '/simulate_test/sumstats/1\n\n')
+            f.write(DIR + '/simulate_test/sumstats/555 other\n')
+            f.write(os.path.join(tmp, 'missing.sumstats.gz') + '\n')
+        for threads in [1, 2]:
+            args.threads = threads
+            x = s.estimate_h2_batch(args, log)
+            assert_array_equal(x.trait, ['1', 'other', 'missing'])
+            assert_equal(x.h2[2], 'NA')
+            for i, fh in enumerate(['1', '555']):
+                args_h2 = parser.parse_args('')
+                args_h2.ref_ld, args_h2.w_ld = args.ref_ld, args.w_ld
+                args_h2.h2, args_h2.out = DIR + '/simulate_test/sumstats/' + fh, args.out
+                y = s.estimate_h2(args_h2, log)
+                assert_almost_equal(x.h2[i], y.tot)
+                assert_almost_equal(x.h2_se[i], y.tot_se)
+                assert_almost_equal(x.intercept[i], y.intercept)
+
+            results = pd.read_csv(args.out + '.h2.results', delim_whitespace=True)
+            assert_array_equal(results.trait, x.trait)
+            for trait in x.trait:
+                assert os.path.exists(args.out + '.' + trait + '.log')
+
+        shutil.rmtree(tmp)
+
+    def test_read_h2_manifest(self):
+        tmp = tempfile.mkdtemp()
+        fh = os.path.join(tmp, 'manifest')
+        with open(fh, 'w') as f:
+            f.write('a/x.sumstats.gz\nb/y.sumstats z\n')
+        assert_equal(s._read_h2_manifest(fh), [('x', 'a/x.sumstats.gz'), ('z', 'b/y.sumstats')])
+        with open(fh, 'w') as f:
+            f.write('a/x.sumstats.gz\nb/x.sumstats\n')
+        assert_raises(ValueError, s._read_h2_manifest, fh)
+        with open(fh, 'w') as f:
+            f.write('# nothing\n')
+        assert_raises(ValueError, s._read_h2_manifest, fh)
+        for name in ('../z', 'a/z', '..'):
+            with open(fh, 'w') as f:
+                f.write('b/y.sumstats {N}\n'.format(N=name))
+            assert_raises(ValueError, s._read_h2_manifest, fh)
+        shutil.rmtree(tmp)
+
     # test statistical properties (constrain intercept here)
     def test_rg_M(self):
         args = parser.parse_args('')
@@ -410,7 +499,7 @@ class Test_Estimate(unittest.TestCase):
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.rg = ','.join(
             [DIR + '/simulate_test/sumstats/1' for _ in xrange(2)])
-        args.out = DIR + '/simulate_test/1'
+        args.out = os.path.join(OUT, '1')
         x = s.estimate_rg(args, log)[0]
         args.M = open(
             DIR + '/simulate_test/ldscore/oneld_onefile.l2.M_5_50', 'rb').read().rstrip('\n')
@@ -428,7 +517,7 @@ class Test_Estimate(unittest.TestCase):
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.rg = ','.join(
             [DIR + '/simulate_test/sumstats/1' for _ in xrange(2)])
-        args.out = DIR + '/simulate_test/1'
+        args.out = os.path.join(OUT, '1')
         args.print_cov = True  # right now just check no runtime errors
         args.print_delete_vals = True
         x = s.estimate_rg(args, log)[0]
@@ -448,7 +537,7 @@ class Test_Estimate(unittest.TestCase):
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.rg = ','.join(
             [DIR + '/simulate_test/sumstats/1' for _ in xrange(2)])
-        args.out = DIR + '/simulate_test/1'
+        args.out = os.path.join(OUT, '1')
         x = s.estimate_rg(args, log)[0]
         args.no_check_alleles = True
         y = s.estimate_rg(args, log)[0]
@@ -462,7 +551,7 @@ class Test_Estimate(unittest.TestCase):
         args.ref_ld = DIR + '/simulate_test/ldscore/oneld_onefile'
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.h2 = DIR + '/simulate_test/sumstats/1'
-        args.out = DIR + '/simulate_test/1'
+        args.out = os.path.join(OUT, '1')
         args.chisq_max = 9999999
         args.two_step = 999
         x = s.estimate_h2(args, log)
@@ -478,7 +567,7 @@ class Test_Estimate(unittest.TestCase):
         args.w_ld = DIR + '/simulate_test/ldscore/w'
         args.rg = ','.join(
             [DIR + '/simulate_test/sumstats/1' for _ in xrange(2)])
-        args.out = DIR + '/simulate_test/rg'
+        args.out = os.path.join(OUT, 'rg')
         args.two_step = 999
         x = s.estimate_rg(args, log)[0]
         args.two_step = 99999